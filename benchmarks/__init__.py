@@ -0,0 +1,6 @@
+"""
+Benchmarks of the order service
+
+Run them from the root of the repository, for example:
+    python -m benchmarks.serialization
+"""
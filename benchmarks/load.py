@@ -0,0 +1,326 @@
+"""
+Load test of the orders API
+
+Seeds --orders Orders of --items items each, built with the factories of
+tests/order_factory.py, then sends a weighted mix of create, get, list,
+ship, cancel and deliver requests from --concurrency clients for
+--duration seconds. Ship and cancel pick Orders that are still placed,
+deliver picks Orders that were shipped, so every transition is one the
+service accepts.
+
+Without --url the service runs in this process on a threaded development
+server, over a database emptied first: a SQLite file by default, or a
+local PostgreSQL given with --database. Pass --url to drive a service
+started on its own, such as gunicorn, instead.
+
+    python -m benchmarks.load [--orders 1000] [--items 3] [--duration 10]
+                              [--concurrency 4] [--mix get=40,list=20,...]
+
+The results are printed as JSON: the p50, p95 and p99 latency in
+milliseconds and the requests per second, in total and per operation.
+Each client draws its operations from a generator seeded with --seed, so
+two runs send the same mix of requests.
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import redirect_stdout
+from urllib.parse import urlsplit
+
+# The weight of each operation in the default mix
+DEFAULT_MIX = {"get": 40, "list": 20, "create": 15, "ship": 10, "cancel": 5, "deliver": 10}
+
+# Orders sent per request when seeding
+SEED_BATCH_SIZE = 1000
+
+
+def parse_mix(text):
+    """ Parses a mix such as get=40,list=20 into the weights of the operations """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError("unknown operation: {}".format(name))
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+def percentile(latencies, fraction):
+    """ Returns the nearest-rank percentile of sorted latencies """
+    if not latencies:
+        return None
+    rank = max(1, math.ceil(fraction * len(latencies)))
+    return latencies[min(rank, len(latencies)) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """ Returns the request count, throughput and latency percentiles in milliseconds """
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+
+def make_order(items):
+    """ Returns the JSON body of a new Order built with the test factories """
+    # the factories import the service, so they are imported once it is configured
+    from tests.order_factory import OrderFactory, OrderItemFactory  # pylint: disable=import-outside-toplevel
+    order = OrderFactory.build(order_items=[OrderItemFactory.build() for _ in range(items)])
+    data = order.serialize()
+    for name in ("id", "created_date", "version", "total_amount", "item_count", "order_status"):
+        del data[name]
+    for item in data["order_items"]:
+        del item["item_id"]
+    return data
+
+
+class Client:
+    """ A keep-alive connection to the service """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def request(self, method, path, body=None):
+        """ Sends a request, returning its status code and decoded JSON body """
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+        return response.status, json.loads(data) if data else None
+
+    def close(self):
+        """ Closes the connection """
+        self.connection.close()
+
+
+class OrderPool:
+    """ The ids of the Orders in each status, shared by the clients """
+
+    def __init__(self):
+        self.ids = {"PLACED": [], "SHIPPED": [], "ANY": []}
+        self._lock = threading.Lock()
+
+    def add(self, status, order_id):
+        """ Notes that an Order is in a status """
+        with self._lock:
+            self.ids[status].append(order_id)
+            if status == "PLACED":
+                self.ids["ANY"].append(order_id)
+
+    def take(self, status, rand):
+        """ Removes and returns a random Order in a status, or None """
+        with self._lock:
+            ids = self.ids[status]
+            if not ids:
+                return None
+            index = rand.randrange(len(ids))
+            ids[index], ids[-1] = ids[-1], ids[index]
+            return ids.pop()
+
+    def pick(self, rand):
+        """ Returns a random Order, whatever its status """
+        with self._lock:
+            return rand.choice(self.ids["ANY"]) if self.ids["ANY"] else None
+
+
+class LoadTest:
+    """ Sends a mix of requests from several clients and records their latency """
+
+    def __init__(self, url, mix, items, concurrency, duration, seed):
+        self.url = url
+        self.mix = mix
+        self.items = items
+        self.concurrency = concurrency
+        self.duration = duration
+        self.seed = seed
+        self.pool = OrderPool()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def seed_orders(self, count):
+        """ Creates count Orders through POST /orders/bulk """
+        client = Client(self.url)
+        try:
+            for start in range(0, count, SEED_BATCH_SIZE):
+                batch = [make_order(self.items) for _ in range(min(SEED_BATCH_SIZE, count - start))]
+                code, report = client.request("POST", "/orders/bulk", batch)
+                if code != 201:
+                    raise RuntimeError("Seeding failed with status {}: {}".format(code, report))
+                for result in report["results"]:
+                    self.pool.add("PLACED", result["id"])
+        finally:
+            client.close()
+
+    def operation(self, name, client, rand, body=None):
+        """ Sends the request of an operation, returning its status code or None if it was skipped """
+        if name == "create":
+            code, order = client.request("POST", "/orders", body)
+            if code == 201:
+                self.pool.add("PLACED", order["id"])
+            return code
+        if name == "list":
+            return client.request("GET", "/orders?limit=100")[0]
+        if name == "get":
+            order_id = self.pool.pick(rand)
+            return client.request("GET", "/orders/{}".format(order_id))[0] if order_id else None
+        take_from = "SHIPPED" if name == "deliver" else "PLACED"
+        order_id = self.pool.take(take_from, rand)
+        if order_id is None:
+            return None
+        code = client.request("PUT", "/orders/{}/{}".format(order_id, name))[0]
+        if code == 200 and name == "ship":
+            self.pool.add("SHIPPED", order_id)
+        return code
+
+    def client_loop(self, index, deadline):
+        """ Sends requests from one client until the deadline """
+        rand = random.Random(self.seed + index)
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        client = Client(self.url)
+        try:
+            while time.perf_counter() < deadline:
+                name = rand.choices(names, weights)[0]
+                # the new Order is built before the clock starts
+                body = make_order(self.items) if name == "create" else None
+                started = time.perf_counter()
+                try:
+                    code = self.operation(name, client, rand, body)
+                except (http.client.HTTPException, OSError):
+                    code = "connection"
+                elapsed = time.perf_counter() - started
+                if code is None:
+                    continue
+                with self._lock:
+                    self.latencies[name].append(elapsed)
+                    if code == "connection" or code >= 400:
+                        self.errors[name] += 1
+        finally:
+            client.close()
+
+    def run(self):
+        """ Runs the clients for the duration and returns the results """
+        started = time.perf_counter()
+        deadline = started + self.duration
+        threads = [threading.Thread(target=self.client_loop, args=(index, deadline))
+                   for index in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        every = [latency for latencies in self.latencies.values() for latency in latencies]
+        return {
+            "total": summarize(every, sum(self.errors.values()), elapsed),
+            "operations": {name: summarize(self.latencies[name], self.errors[name], elapsed)
+                           for name in sorted(self.latencies)},
+        }
+
+
+def serve(database):
+    """ Starts the service in this process over an empty database, returning its URL and server """
+    os.environ["DATABASE_URI"] = database
+    # the service reads its configuration when it is imported
+    from werkzeug.serving import make_server  # pylint: disable=import-outside-toplevel
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import Order, db  # pylint: disable=import-outside-toplevel
+    app.logger.disabled = True
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    db.drop_all()
+    Order.create_db()
+    Order.cache.clear()
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_port), server
+
+
+def run(url=None, database=None, orders=1000, items=3, duration=10.0, concurrency=4,
+        mix=None, seed=1):
+    """ Seeds the Orders, runs the load test and returns the results """
+    # pylint: disable=too-many-arguments
+    mix = mix or DEFAULT_MIX
+    server = None
+    # the service prints while it starts, stdout is kept for the results
+    with redirect_stdout(sys.stderr):
+        if url is None:
+            url, server = serve(database)
+        else:
+            # the factories build Orders with the models, which need a configured service
+            os.environ.setdefault("DATABASE_URI", "sqlite://")
+            import service  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+    import factory.random  # pylint: disable=import-outside-toplevel
+    factory.random.reseed_random(seed)
+    random.seed(seed)
+    try:
+        test = LoadTest(url, mix, items, concurrency, duration, seed)
+        seed_started = time.perf_counter()
+        test.seed_orders(orders)
+        seed_time = time.perf_counter() - seed_started
+        results = test.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+    return {
+        "target": "in-process" if server is not None else url,
+        "database": urlsplit(database).scheme if server is not None else None,
+        "orders": orders,
+        "items_per_order": items,
+        "concurrency": concurrency,
+        "duration_s": duration,
+        "seed": seed,
+        "mix": mix,
+        "seed_time_s": round(seed_time, 3),
+        **results,
+    }
+
+
+def main():
+    """ Runs the load test from the command line """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="URL of a running service, instead of one in this process")
+    parser.add_argument("--database", help="database of the service run in this process",
+                        default="sqlite:///" + os.path.join(tempfile.gettempdir(),
+                                                            "orders-benchmark.db"))
+    parser.add_argument("--orders", type=int, default=1000, help="Orders to seed")
+    parser.add_argument("--items", type=int, default=3, help="items per Order")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="weights of the operations, such as get=40,list=20,create=15")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random choices")
+    parser.add_argument("--output", help="file to write the results to, besides stdout")
+    args = parser.parse_args()
+    results = run(args.url, args.database, args.orders, args.items, args.duration,
+                  args.concurrency, args.mix, args.seed)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Microbenchmark of the validation and serialization of the models
+
+Times the paths every write and read of an Order goes through, for Orders
+of 1, 10, 100 and 1,000 items:
+
+  deserialize  Order.deserialize() of a valid body, which validates and
+               builds every OrderItem
+  validate     Order.deserialize() of a body whose last item is invalid,
+               the cost of rejecting a bad request
+  serialize    Order.serialize() of the Order that was deserialized
+  encode       Order.serialize() then the JSON encoding of the response
+
+Each path is also run once under tracemalloc, which reports the peak of
+the memory it allocated and the memory still held by its result.
+
+    python -m benchmarks.models [--sizes 1,10,100,1000] [--repeat 5]
+
+The results are printed as JSON, in microseconds per call and per item.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from contextlib import redirect_stdout
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+# the service prints while it starts, stdout is kept for the results
+with redirect_stdout(sys.stderr):
+    from service import serialization  # noqa: E402
+    from service.models import DataValidationError, Order  # noqa: E402
+    from benchmarks.serialization import make_orders  # noqa: E402
+
+# The number of items of the Orders timed by default
+DEFAULT_SIZES = (1, 10, 100, 1000)
+
+
+def make_body(items):
+    """ Returns the JSON body of an Order with items, as a client would send it """
+    return make_orders(1, items)[0].serialize()
+
+
+def make_invalid_body(items):
+    """ Returns the body of an Order whose last item has a status that doesn't exist """
+    body = make_body(items)
+    body["order_items"][-1]["status"] = "LOST"
+    return body
+
+
+def deserialize(body):
+    """ Builds an Order from a valid body """
+    return Order().deserialize(body)
+
+
+def validate(body):
+    """ Rejects a body with an invalid item """
+    try:
+        Order().deserialize(body)
+    except DataValidationError as error:
+        return error
+    raise AssertionError("The invalid body was accepted")
+
+
+def time_per_call(function, argument, items, repeat):
+    """ Returns the best time of function over argument, in microseconds per call """
+    number = max(1, 2000 // items)
+    best = min(timeit.repeat(lambda: function(argument), number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+def allocations(function, argument):
+    """ Returns the peak and the retained bytes allocated by one call of function """
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        result = function(argument)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak - before, current - before
+
+
+def measure(function, argument, items, repeat):
+    """ Returns the timings and allocations of one path """
+    per_call = time_per_call(function, argument, items, repeat)
+    peak, retained = allocations(function, argument)
+    return {
+        "us_per_call": round(per_call, 2),
+        "us_per_item": round(per_call / items, 3),
+        "peak_bytes": peak,
+        "retained_bytes": retained,
+    }
+
+
+def run(sizes=DEFAULT_SIZES, repeat=5):
+    """ Measures every path for Orders of each size """
+    results = []
+    for items in sizes:
+        body = make_body(items)
+        order = deserialize(body)
+        order.summarize()
+        results.append({
+            "items": items,
+            "deserialize": measure(deserialize, body, items, repeat),
+            "validate": measure(validate, make_invalid_body(items), items, repeat),
+            "serialize": measure(Order.serialize, order, items, repeat),
+            "encode": measure(lambda order: serialization.dumps(order.serialize()),
+                              order, items, repeat),
+        })
+    return {
+        "encoder": "orjson" if serialization.orjson is not None else "json",
+        "results": results,
+    }
+
+
+def main():
+    """ Runs the benchmark from the command line """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated numbers of items per Order")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each timing")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    print(json.dumps(run(sizes, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
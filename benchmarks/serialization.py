@@ -0,0 +1,113 @@
+"""
+Microbenchmark of the JSON encoding of Orders
+
+Compares the path responses used to take, Order.serialize() then marshal()
+with the API model then json.dumps(), with the fast path, Order.serialize()
+then dumps(), for a single Order and for a page of 1,000 Orders. The fast
+path is timed with the encoder that is installed (orjson when available)
+and with the standard library.
+
+    python -m benchmarks.serialization [--items 3] [--repeat 5]
+
+The results are printed as JSON, in microseconds per Order.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from contextlib import redirect_stdout
+from datetime import datetime
+from unittest.mock import patch
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+# the service prints while it starts, stdout is kept for the results
+with redirect_stdout(sys.stderr):
+    from flask_restx import marshal  # noqa: E402
+    from service import serialization  # noqa: E402
+    from service.models import Order, OrderItem  # noqa: E402
+    from service.service import order_model  # noqa: E402
+
+
+def make_orders(count, items):
+    """ Returns Orders as they are after being loaded, without a database """
+    orders = []
+    for order_id in range(1, count + 1):
+        order = Order(id=order_id, customer_id=order_id % 97, created_date=datetime.now(),
+                      version=1, order_items=[
+                          OrderItem(item_id=order_id * items + index, product_id=index,
+                                    quantity=index + 1, price=9.99, status="PLACED")
+                          for index in range(items)])
+        order.summarize()
+        orders.append(order)
+    return orders
+
+
+def legacy_serialize(order):
+    """ Order.serialize() as it was before it returned created_date in ISO form """
+    return {
+        "id": order.id,
+        "customer_id": order.customer_id,
+        "created_date": order.created_date,
+        "version": order.version,
+        "total_amount": order.total_amount,
+        "item_count": order.item_count,
+        "order_status": order.order_status,
+        "order_items": [item.serialize() for item in order.order_items],
+    }
+
+
+def legacy(orders):
+    """ Encodes Orders by marshalling them with the API model first """
+    return json.dumps(marshal([legacy_serialize(order) for order in orders], order_model))
+
+
+def fast(orders):
+    """ Encodes Orders in one pass """
+    return serialization.dumps([order.serialize() for order in orders])
+
+
+def time_per_order(function, orders, repeat):
+    """ Returns the best time of function over orders, in microseconds per Order """
+    number = max(1, 2000 // len(orders))
+    best = min(timeit.repeat(lambda: function(orders), number=number, repeat=repeat))
+    return best / number / len(orders) * 1e6
+
+
+def run(items=3, repeat=5):
+    """ Times every path for 1 and 1,000 Orders """
+    results = []
+    for count in (1, 1000):
+        orders = make_orders(count, items)
+        legacy_time = time_per_order(legacy, orders, repeat)
+        fast_time = time_per_order(fast, orders, repeat)
+        with patch.object(serialization, "orjson", None):
+            stdlib_time = time_per_order(fast, orders, repeat)
+        results.append({
+            "orders": count,
+            "legacy_us_per_order": round(legacy_time, 2),
+            "fast_us_per_order": round(fast_time, 2),
+            "fast_stdlib_us_per_order": round(stdlib_time, 2),
+            "legacy_ms_total": round(legacy_time * count / 1000, 3),
+            "fast_ms_total": round(fast_time * count / 1000, 3),
+            "speedup": round(legacy_time / fast_time, 2),
+        })
+    return {
+        "encoder": "orjson" if serialization.orjson is not None else "json",
+        "items_per_order": items,
+        "results": results,
+    }
+
+
+def main():
+    """ Runs the benchmark from the command line """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=3, help="items per Order")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each timing")
+    args = parser.parse_args()
+    print(json.dumps(run(args.items, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
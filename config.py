@@ -10,6 +10,65 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Comma separated URIs of read replicas serving the reads of GET requests
+DATABASE_REPLICA_URIS = os.getenv("DATABASE_REPLICA_URIS", "")
+# Seconds between two health checks of a replica
+DATABASE_REPLICA_CHECK_INTERVAL = int(os.getenv("DATABASE_REPLICA_CHECK_INTERVAL", "5"))
+
+# Connection pool of each worker, not used with SQLite
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Seconds to wait for a connection before failing the request
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Seconds after which a connection is replaced, -1 to keep connections forever
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Test each connection before use so a database failover doesn't fail requests
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+
+# Retries of database work that failed for a transient reason: attempts in
+# total, jittered backoff doubling from the base delay and a deadline per call
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", "4"))
+DB_RETRY_BASE_DELAY_MS = int(os.getenv("DB_RETRY_BASE_DELAY_MS", "20"))
+DB_RETRY_MAX_DELAY_MS = int(os.getenv("DB_RETRY_MAX_DELAY_MS", "500"))
+DB_RETRY_DEADLINE_MS = int(os.getenv("DB_RETRY_DEADLINE_MS", "2000"))
+
+# Pagination of the order listings
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+# Number of rows fetched per round trip when streaming the order listing
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+
+# Bulk order creation
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "500"))
+BULK_MAX_ORDERS = int(os.getenv("BULK_MAX_ORDERS", "10000"))
+
+# Cache of single orders: "memory" (per worker LRU), "redis" (shared) or "none"
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "30"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Compression of the JSON responses: responses with a known length are only
+# compressed from COMPRESS_MIN_SIZE bytes on, streamed ones always. The level
+# is the gzip level and the brotli quality, 0 turns compression off
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+# Slow request log: requests slower than SLOW_REQUEST_MS, or with a statement
+# slower than SLOW_QUERY_MS, are logged with every SQL statement they sent.
+# Only a SLOW_LOG_SAMPLE_RATE fraction of the requests (0 to 1) is watched,
+# and each worker writes at most SLOW_LOG_MAX_PER_MINUTE entries
+SLOW_REQUEST_MS = int(os.getenv("SLOW_REQUEST_MS", "500"))
+SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_LOG_SAMPLE_RATE = float(os.getenv("SLOW_LOG_SAMPLE_RATE", "1.0"))
+SLOW_LOG_MAX_PER_MINUTE = int(os.getenv("SLOW_LOG_MAX_PER_MINUTE", "10"))
+
+# Requests sent with the PROFILE_SECRET in their X-Profile header are run
+# under cProfile and their profile is stored in PROFILE_DIR. Profiling is
+# off while the secret is empty
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
@@ -1,6 +1,76 @@
+"""
+Gunicorn configuration of the order service
+
+The worker model is switched with GUNICORN_WORKER_CLASS:
+
+  gthread (default)  each worker process serves requests from a pool of
+                     threads, so a slow query only holds up its own thread
+  gevent             each worker serves requests from greenlets; needs the
+                     gevent and psycogreen packages so psycopg2 yields to
+                     other greenlets while it waits on PostgreSQL
+  sync               one request at a time per worker
+
+GUNICORN_WORKERS (or WEB_CONCURRENCY) sets the number of worker processes,
+one by default, and GUNICORN_THREADS overrides the threads derived from the
+number of CPUs. Every worker creates the tables the database lacks as it
+starts; the columns and indexes existing tables lack are added by `flask
+upgrade-db`, run before gunicorn. Database sessions are scoped to the
+application context, which Flask keeps per thread and per greenlet, so every
+worker class gets a session of its own for each request.
+
+Every worker writes its Prometheus metrics to the prometheus_multiproc_dir
+directory so that /metrics reports the totals of all of them. A temporary
+directory is used when the variable isn't set, and the directory is
+emptied when gunicorn starts.
+"""
+import glob
+import multiprocessing
 import os
+import tempfile
+
+CPU_COUNT = multiprocessing.cpu_count()
 
 PORT = os.getenv("PORT", "5000")
 bind = "0.0.0.0:" + PORT
-workers = 1
 log_level = "info"
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# cpu_count() sees every CPU of the host inside a container, so the count is
+# not derived from it: one worker fits the 256M of manifest.yml, raise it with
+# WEB_CONCURRENCY (set by some platforms) or GUNICORN_WORKERS
+workers = int(os.getenv("GUNICORN_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+# Only used by gthread workers; each thread may hold one database connection
+threads = int(os.getenv("GUNICORN_THREADS", str(min(CPU_COUNT * 2, 8))))
+# Only used by gevent workers: concurrent requests per worker
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# The workers import prometheus_client after the configuration is read, so a
+# directory set here makes them share their metrics even when the Procfile
+# or the environment doesn't name one
+if not os.getenv("prometheus_multiproc_dir"):
+    os.environ["prometheus_multiproc_dir"] = tempfile.mkdtemp(prefix="orders-metrics-")
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """ Makes psycopg2 cooperative before a gevent worker loads the app """
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+        patch_psycopg()
+        server.log.info("Patched psycopg2 for gevent in worker %s", worker.pid)
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """ Removes the Prometheus metrics left over by a previous run """
+    path = os.getenv("prometheus_multiproc_dir")
+    if path:
+        for name in glob.glob(os.path.join(path, "*.db")):
+            os.remove(name)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """ Stops reporting the live metrics of a worker that exited """
+    if os.getenv("prometheus_multiproc_dir"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+        multiprocess.mark_process_dead(worker.pid)
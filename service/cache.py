@@ -0,0 +1,184 @@
+"""
+Module to define the caches that serve single Orders without a database query
+
+Every backend implements the CacheBackend interface. LRUCache keeps the
+entries inside the worker process, SharedCache keeps them in a key-value
+store such as Redis so that every worker sees the same entries.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class CacheBackend:
+    """ Interface of the cache backends """
+
+    # True when every worker sees the same entries, so an entry removed by
+    # one worker is gone for all of them
+    shared = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the value stored under key, or None """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Stores a value under key """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes the value stored under key, if any """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every value """
+        raise NotImplementedError
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counters of the cache """
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class NullCache(CacheBackend):
+    """ A cache that never stores anything, used when caching is disabled """
+
+    def get(self, key):
+        self.misses += 1
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    """
+    An in-process cache bounded in size and in the age of its entries
+
+    The least recently used entry is evicted once max_entries is reached,
+    and entries older than ttl seconds are treated as missing. As every
+    worker has its own LRUCache, ttl also bounds how long another worker
+    may serve an entry that was invalidated here, unless the entry is
+    checked against the database before it is served.
+    """
+
+    def __init__(self, max_entries=10000, ttl=30, clock=time.monotonic):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats["size"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+class SharedCache(CacheBackend):
+    """
+    A cache kept in a key-value store shared by every worker
+
+    The client only needs the get, setex, delete and scan_iter commands of
+    a Redis client. Values are stored as JSON with datetimes in ISO 8601
+    form, and the store expires them after ttl seconds. Evictions are up to
+    the store and are not counted here.
+    """
+
+    shared = True
+
+    def __init__(self, client, ttl=30, prefix="orders:"):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key):
+        return "{}{}".format(self.prefix, key)
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.setex(self._key(key), self.ttl, json.dumps(value, default=_json_default))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+def _json_default(value):
+    """ Encodes the values json can't encode on its own """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def create_cache(config):
+    """
+    Creates the cache backend selected by CACHE_BACKEND
+
+    :param config: the configuration of the Flask app
+
+    """
+    backend = config.get("CACHE_BACKEND", "memory")
+    if backend == "none":
+        return NullCache()
+    if backend == "redis":
+        import redis  # pylint: disable=import-outside-toplevel
+        client = redis.Redis.from_url(config["CACHE_REDIS_URL"])
+        return SharedCache(client, ttl=config["CACHE_TTL"])
+    return LRUCache(max_entries=config["CACHE_MAX_ENTRIES"], ttl=config["CACHE_TTL"])
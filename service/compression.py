@@ -0,0 +1,106 @@
+"""
+Module to compress the JSON responses for the clients that accept it
+
+Responses are compressed with brotli when it is installed and the client
+accepts it, with gzip otherwise. Responses with a known length are only
+compressed from COMPRESS_MIN_SIZE bytes on, smaller ones cost more CPU
+than they save on the wire. Streamed responses are compressed as they are
+written, one chunk at a time.
+"""
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+# The content types worth compressing
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson")
+
+
+def available_encodings():
+    """ Returns the content codings the server can produce, preferred first """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def choose_encoding(accept_encodings):
+    """
+    Returns the content coding to compress a response with, or None
+
+    :param accept_encodings: the Accept-Encoding header of the request
+    """
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compressor(encoding, level):
+    """ Returns a function that compresses chunks and a function that ends the stream """
+    if encoding == "br":
+        # brotli qualities go up to 11, the gzip levels up to 9
+        compress = brotli.Compressor(quality=level)
+        return compress.process, compress.finish
+    # wbits of 16 + 15 writes a gzip header and trailer around the deflate stream
+    compress = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compress.compress, compress.flush
+
+
+def compress(data, encoding, level):
+    """ Compresses a whole body """
+    process, finish = compressor(encoding, level)
+    return process(data) + finish()
+
+
+def compress_stream(chunks, encoding, level):
+    """ Compresses a streamed body, yielding compressed data as it becomes available """
+    process, finish = compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            data = process(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # closing the body runs the teardown of a stream_with_context generator
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response, accept_encodings, min_size, level):
+    """
+    Compresses a response in place for a client that accepts it
+
+    The ETag of a compressed response is made weak: it names the same
+    version of the resource as the uncompressed response, but not the
+    same bytes.
+
+    :param response: the response to compress
+    :param accept_encodings: the Accept-Encoding header of the request
+    :param min_size: the size under which a response is sent as it is
+    :param level: the gzip level and brotli quality, 0 turns compression off
+
+    """
+    if (level <= 0 or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or not 200 <= response.status_code < 300 or response.status_code == 204
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, level))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
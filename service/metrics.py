@@ -0,0 +1,105 @@
+"""
+Module to measure the requests and export the measures to Prometheus
+
+Each request records its latency, its status code, the number of SQL
+statements it sent and the time they took. The statements are timed by the
+StatementTimer shared with the slow request log, so the reads sent to the
+read replicas are counted too.
+
+Under gunicorn every worker process keeps its own measures. When the
+prometheus_multiproc_dir environment variable names a directory, the
+workers write their measures there and /metrics adds up the measures of
+every worker.
+"""
+import os
+import time
+from flask import g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+                               Histogram, generate_latest, multiprocess)
+from .statements import statement_timer
+
+# Buckets of the number of SQL statements sent by a request
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, float("inf"))
+
+
+def is_multiprocess():
+    """ Returns True if the measures are shared by several worker processes """
+    return "prometheus_multiproc_dir" in os.environ
+
+
+class RequestMeasures:
+    """ The measures of a request in progress """
+
+    def __init__(self, started):
+        self.started = started
+        self.statements = 0
+        self.database_time = 0.0
+
+
+class RequestMetrics:
+    """
+    The latency, status and database work of the requests to the app
+
+    The measures are labelled with the method and the URL rule of the
+    request, such as /orders/<int:order_id>, so that they don't grow with
+    the number of Orders.
+    """
+
+    def __init__(self, registry=REGISTRY, clock=time.perf_counter, timer=statement_timer):
+        self.registry = registry
+        self.clock = clock
+        self.timer = timer
+        self.latency = Histogram(
+            "http_request_duration_seconds", "Time spent answering a request",
+            ["method", "route"], registry=registry)
+        self.responses = Counter(
+            "http_requests_total", "Requests answered, by status code",
+            ["method", "route", "status"], registry=registry)
+        self.statements = Histogram(
+            "http_request_sql_statements", "SQL statements sent by a request",
+            ["method", "route"], buckets=STATEMENT_BUCKETS, registry=registry)
+        self.database_time = Histogram(
+            "http_request_database_duration_seconds", "Time a request spent in SQL statements",
+            ["method", "route"], registry=registry)
+        # each instance keeps the measures of the current request in g under its own name
+        self._key = "request_metrics_{}".format(id(self))
+        self._listening = False
+
+    def init_app(self, app):
+        """ Measures the requests to app and the SQL statements they send """
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        if not self._listening:
+            self.timer.add_listener(self._record_statement)
+            self._listening = True
+
+    def start_request(self):
+        """ Starts measuring the current request """
+        setattr(g, self._key, RequestMeasures(self.clock()))
+
+    def end_request(self, response):
+        """ Records the measures of the current request """
+        measures = g.get(self._key)
+        if measures is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        self.latency.labels(request.method, route).observe(self.clock() - measures.started)
+        self.responses.labels(request.method, route, response.status_code).inc()
+        self.statements.labels(request.method, route).observe(measures.statements)
+        self.database_time.labels(request.method, route).observe(measures.database_time)
+        return response
+
+    def _record_statement(self, statement, duration, cursor):  # pylint: disable=unused-argument
+        measures = g.get(self._key)
+        if measures is None:
+            return
+        measures.statements += 1
+        measures.database_time += duration
+
+    def export(self):
+        """ Returns the measures in the Prometheus text format and its content type """
+        registry = self.registry
+        if is_multiprocess():
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -2,19 +2,88 @@
 Module to define the models for the orders resource.
 """
 import logging
+from contextlib import contextmanager
 from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
-from retry import retry
-from urllib.error import HTTPError
+from itertools import islice
+from sqlalchemy import case, func, inspect, select, text, tuple_
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.orm import joinedload, load_only, noload, selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.schema import CreateColumn
+from .cache import NullCache, create_cache
+from .retry import RetryPolicy
+from .routing import RoutingSQLAlchemy
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# Retries database work that failed for a transient reason, configured in init_db()
+db_retry = RetryPolicy(rollback=db.session.rollback)
 
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class ConcurrencyError(Exception):
+    """ Used when an Order was changed by another request since it was read """
+
+
+# The statuses an item may have
+ITEM_STATUSES = ("PLACED", "SHIPPED", "DELIVERED", "CANCELLED")
+
+# The statuses an item may be moved to, each with the statuses it may be
+# moved from. Moving an item to the status it already has is accepted but
+# writes nothing, so the version of its Order stays the same.
+ITEM_TRANSITIONS = {
+    "SHIPPED": ("PLACED", "SHIPPED"),
+    "DELIVERED": ("SHIPPED",),
+    "CANCELLED": ("PLACED", "CANCELLED"),
+}
+
+# Why an item can't be moved to a status (first) from its current one (second)
+ITEM_TRANSITION_ERRORS = {
+    ("SHIPPED", "CANCELLED"): "Item has already been cancelled/delivered",
+    ("SHIPPED", "DELIVERED"): "Item has already been cancelled/delivered",
+    ("DELIVERED", "PLACED"): "Item has not been shipped yet.",
+    ("DELIVERED", "CANCELLED"): "Item has already been cancelled.",
+    ("DELIVERED", "DELIVERED"): "Item has already been delivered.",
+    ("CANCELLED", "SHIPPED"): "Item has already been shipped/delivered",
+    ("CANCELLED", "DELIVERED"): "Item has already been shipped/delivered",
+}
+
+# The summary status of an Order is the first of these its items have, or
+# CANCELLED when every item is cancelled
+ORDER_STATUS_PRECEDENCE = ("PLACED", "SHIPPED", "DELIVERED")
+
+# The key of the PostgreSQL advisory lock held while the schema is created
+SCHEMA_LOCK_KEY = 7319104
+
+# The columns the Orders may be sorted on, besides id
+ORDER_SORT_COLUMNS = ("created_date", "total_amount", "item_count")
+
+# The fields of a serialized Order, in the order they are serialized
+ORDER_FIELDS = ("id", "created_date", "customer_id", "version", "total_amount", "item_count",
+                "order_status", "order_items")
+
+# The statuses a whole Order may be moved to, each with the statuses of the
+# items that move with it. Items in any other status are left alone.
+ORDER_TRANSITIONS = {
+    "SHIPPED": ("PLACED",),
+    "DELIVERED": ("SHIPPED",),
+    "CANCELLED": ("PLACED",),
+}
+
+
+def summary_status(statuses):
+    """ Returns the summary status of an Order from the statuses of its items """
+    statuses = set(statuses)
+    for status in ORDER_STATUS_PRECEDENCE:
+        if status in statuses:
+            return status
+    return "CANCELLED" if statuses else "PLACED"
+
+
 class OrderItem(db.Model):
     """ Class that represents an Order Item """
     app = None
@@ -22,6 +91,9 @@ class OrderItem(db.Model):
     ##################################################
     # Order Item Table Schema
     ##################################################
+    # the composite index also serves lookups on order_id alone
+    __table_args__ = (db.Index("ix_order_item_order_id_status", "order_id", "status"),
+                      db.Index("ix_order_item_product_id_order_id", "product_id", "order_id"))
     item_id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.Integer, nullable=False, default=1)
@@ -67,7 +139,7 @@ class OrderItem(db.Model):
                 raise DataValidationError("Invalid order: invalid price")
             if self.status is None or not isinstance(self.status, str):
                 raise DataValidationError("Invalid order: invalid status")
-            if self.status not in ['PLACED', 'SHIPPED', 'DELIVERED', 'CANCELLED']:
+            if self.status not in ITEM_STATUSES:
                 raise DataValidationError("Invalid order: status not in list")
         except KeyError as error:
             raise DataValidationError("Invalid order: missing " + error.args[0])
@@ -77,24 +149,132 @@ class OrderItem(db.Model):
             )
         return self
 
+    @classmethod
+    @db_retry
+    def find(cls, order_id, item_id):
+        """ Finds an OrderItem by it's ID inside an Order """
+        return cls.query.filter(cls.order_id == order_id, cls.item_id == item_id).first()
+
+    @classmethod
+    @db_retry
+    def transition_status(cls, order_id, item_id, new_status, version=None):
+        """Moves an OrderItem to a new status with one conditional UPDATE
+
+        The current status is checked in the WHERE clause of the UPDATE
+        itself, so the item is never read first and two workers can't both
+        act on the same stale status.
+
+        :param order_id: the id of the Order the item belongs to
+        :param item_id: the id of the OrderItem
+        :param new_status: one of the statuses in ITEM_TRANSITIONS
+        :param version: the version the Order must still be at when the item
+                        moves, checked by the UPDATE of the Order; when it
+                        is not, nothing is moved and ConcurrencyError is raised
+
+        :return: True if the item was moved, False if it doesn't exist, is
+                 already in new_status or its current status doesn't allow
+                 the transition
+        :rtype: bool
+        """
+        count = cls.query.filter(
+            cls.item_id == item_id,
+            cls.order_id == order_id,
+            cls.status.in_(ITEM_TRANSITIONS[new_status]),
+            cls.status != new_status,
+        ).update({cls.status: new_status}, synchronize_session=False)
+        if count and not Order.mark_changed([order_id], version):
+            db.session.rollback()
+            raise ConcurrencyError(
+                "Order with id '{}' has been changed by another request.".format(order_id))
+        db.session.commit()
+        if count:
+            Order.cache.delete(order_id)
+        return count == 1
+
+    @classmethod
+    @db_retry
+    def bulk_transition(cls, item_ids, new_status):
+        """Moves many OrderItems to a new status in one transaction
+
+        The current statuses are read and the items locked with one SELECT
+        ... FOR UPDATE, so no other transaction can change them before every
+        eligible item is moved with one UPDATE and the outcomes tell what
+        the UPDATE did.
+
+        :param item_ids: the ids of the OrderItems
+        :param new_status: one of the statuses in ITEM_TRANSITIONS
+
+        :return: each item id found mapped to None if it was moved, or to
+                 the reason it was not; missing ids are left out
+        :rtype: dict
+        """
+        rows = cls.locked(cls.item_id.in_(item_ids)).all()
+        outcomes = {item_id: cls.transition_error(current, new_status)
+                    for item_id, _, current in rows}
+        # the items already in new_status are accepted but not written
+        moved = [(item_id, order_id) for item_id, order_id, current in rows
+                 if outcomes[item_id] is None and current != new_status]
+        if moved:
+            cls.query.filter(
+                cls.item_id.in_([item_id for item_id, _ in moved]),
+                cls.status.in_(ITEM_TRANSITIONS[new_status]),
+                cls.status != new_status,
+            ).update({cls.status: new_status}, synchronize_session=False)
+        order_ids = {order_id for _, order_id in moved}
+        Order.mark_changed(order_ids)
+        db.session.commit()
+        for order_id in order_ids:
+            Order.cache.delete(order_id)
+        return outcomes
+
+    @classmethod
+    def locked(cls, *criteria):
+        """Returns the id, order id and status of the items matching criteria, locking them
+
+        The rows stay locked until the transaction ends. They are locked in
+        item_id order, so two transitions of the same items can't deadlock.
+        """
+        return db.session.query(cls.item_id, cls.order_id, cls.status) \
+            .filter(*criteria).order_by(cls.item_id).with_for_update()
+
+    @staticmethod
+    def transition_error(current_status, new_status):
+        """ Returns why an item can't move from current_status to new_status, or None """
+        if current_status in ITEM_TRANSITIONS[new_status]:
+            return None
+        return ITEM_TRANSITION_ERRORS.get((new_status, current_status),
+                                          "Item can't be moved to {}".format(new_status))
+
 
 class Order(db.Model):
     """ Class that represents an Order """
     logger = logging.getLogger(__name__)
     app = None
+    # serialized Orders by id, replaced by the configured backend in init_db()
+    cache = NullCache()
 
     ##################################################
     # Order Table Schema
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, nullable=False)
-    created_date = db.Column(db.DateTime(), default=datetime.now)
-    order_items = db.relationship('OrderItem', backref='order', cascade="all, delete", lazy=True)
+    customer_id = db.Column(db.Integer, nullable=False, index=True)
+    created_date = db.Column(db.DateTime(), default=datetime.now, index=True)
+    # bumped on every change to the Order or its items, see update()
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # summary of the items, kept up to date by summarize() and mark_changed()
+    total_amount = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    order_status = db.Column(db.String, nullable=False, default="PLACED",
+                             server_default="PLACED", index=True)
+    order_items = db.relationship('OrderItem', backref='order', cascade="all, delete", lazy=True,
+                                  order_by='OrderItem.item_id')
+    __table_args__ = (db.Index("ix_order_total_amount_id", "total_amount", "id"),)
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": False}
 
     def __repr__(self):
         return "<Order %r>" % self.id
 
-    @retry(HTTPError, delay=1, backoff=2, tries=5)
+    @db_retry
     def create(self):
         """
         Creates an order in the database
@@ -105,13 +285,18 @@ class Order(db.Model):
         if len(self.order_items) == 0:
             raise DataValidationError("Order Items can't be empty")
 
+        self.summarize()
         db.session.add(self)
+        db.session.flush()
+        order_id = self.id
         db.session.commit()
+        self.cache.delete(order_id)
 
-    @retry(HTTPError, delay=1, backoff=2, tries=5)
     def update(self):
         """
         Updates an Order to the database
+
+        Not retried: rolling back the session discards the changes to update.
         """
         if not self.id or not isinstance(self.id, int):
             raise DataValidationError("Update called with invalid id field")
@@ -119,25 +304,260 @@ class Order(db.Model):
             raise DataValidationError("Customer Id is not valid")
         if len(self.order_items) == 0:
             raise DataValidationError("Order Items can't be empty")
-        db.session.commit()
+        order_id = self.id
+        self.summarize()
+        if inspect(self).persistent:
+            # always write the order row, even when only items changed, so
+            # the UPDATE checks and bumps the version the Order was read at
+            self.version += 1
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise ConcurrencyError(
+                "Order with id '{}' has been changed by another request.".format(order_id))
+        self.cache.delete(order_id)
 
-    @retry(HTTPError, delay=1, backoff=2, tries=5)
+    @db_retry
     def delete(self):
         """
         Removes an Order from the data store
+
+        The DELETE checks the version the Order was read at. When another
+        request deleted the Order first there is nothing left to do, when it
+        changed the Order ConcurrencyError is raised.
+        """
+        order_id = self.id
+        try:
+            db.session.delete(self)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            if self.find_version(order_id) is not None:
+                raise ConcurrencyError(
+                    "Order with id '{}' has been changed by another request.".format(order_id))
+        self.cache.delete(order_id)
+
+    @classmethod
+    @db_retry
+    def bulk_transition(cls, order_ids, new_status, version=None):
+        """Moves the items of many Orders to a new status in one transaction
+
+        The items of every Order are read and locked with one SELECT ...
+        FOR UPDATE, and their status counts checked against the rules of
+        transition_error. No other transaction can change the items before
+        those of every eligible Order are moved with one UPDATE, so the
+        outcomes tell what the UPDATE did.
+
+        :param order_ids: the ids of the Orders
+        :param new_status: one of the statuses in ORDER_TRANSITIONS
+        :param version: the version every Order moved must still be at,
+                        checked by the UPDATE of the Orders; when one is
+                        not, nothing is moved and ConcurrencyError is raised
+
+        :return: each order id found mapped to None if it was moved, or to
+                 the reason it was not; missing ids are left out
+        :rtype: dict
         """
-        db.session.delete(self)
+        status_counts = {}
+        for _, order_id, item_status in OrderItem.locked(OrderItem.order_id.in_(order_ids)):
+            counts = status_counts.setdefault(order_id, {})
+            counts[item_status] = counts.get(item_status, 0) + 1
+        # the ids without items are only looked up when there are some, such as missing ids
+        unseen = set(order_ids).difference(status_counts)
+        if unseen:
+            for (order_id,) in db.session.query(cls.id).filter(cls.id.in_(unseen)):
+                status_counts[order_id] = {}
+        outcomes = {order_id: cls.transition_error(counts, new_status)
+                    for order_id, counts in status_counts.items()}
+        # an eligible Order without items to move is accepted but not written
+        moved = [order_id for order_id, error in outcomes.items()
+                 if error is None and any(status_counts[order_id].get(status)
+                                          for status in ORDER_TRANSITIONS[new_status])]
+        if moved:
+            OrderItem.query.filter(
+                OrderItem.order_id.in_(moved),
+                OrderItem.status.in_(ORDER_TRANSITIONS[new_status]),
+            ).update({OrderItem.status: new_status}, synchronize_session=False)
+        if cls.mark_changed(moved, version) < len(moved):
+            db.session.rollback()
+            raise ConcurrencyError("An Order has been changed by another request.")
         db.session.commit()
+        for order_id in moved:
+            cls.cache.delete(order_id)
+        return outcomes
 
-    def serialize(self):
-        """ Serializes an order into a dictionary """
+    @staticmethod
+    def transition_error(status_counts, new_status):
+        """Returns why an Order can't be moved to new_status, or None
+
+        :param status_counts: the number of items of the Order in each status
+        :param new_status: one of the statuses in ORDER_TRANSITIONS
+
+        """
+        total = sum(status_counts.values())
+        if new_status == "SHIPPED":
+            if status_counts.get("DELIVERED", 0) + status_counts.get("CANCELLED", 0) == total:
+                return ("All the items in this order are DELIVERED/SHIPPED/CANCELED, "
+                        "no items can be shipped.")
+        elif new_status == "DELIVERED":
+            if status_counts.get("PLACED", 0):
+                return "At least one item in this order is PLACED, order cannot be delivered."
+            if status_counts.get("CANCELLED", 0) == total:
+                return "All the items in this order are CANCELLED, no items can be delivered."
+        elif new_status == "CANCELLED":
+            if status_counts.get("SHIPPED", 0) + status_counts.get("DELIVERED", 0) == total:
+                return "All the items have been shipped/delivered. Nothing to cancel"
+        return None
+
+    def summarize(self):
+        """ Sets the summary columns from the items of the Order """
+        self.item_count = len(self.order_items)
+        self.total_amount = sum(item.quantity * item.price for item in self.order_items
+                                if item.status != "CANCELLED")
+        self.order_status = summary_status(item.status for item in self.order_items)
+
+    @classmethod
+    def mark_changed(cls, order_ids, version=None):
+        """Records a change made with SQL outside of update() to the items of Orders
+
+        Bumps the version and recomputes the summary columns of the Orders
+        in one UPDATE. Runs inside the caller's transaction, so it also makes
+        any update() of the same Orders that read the old version fail.
+
+        :param order_ids: the ids of the Orders whose items changed
+        :param version: when given, only the Orders still at this version
+                        are updated
+
+        :return: the number of Orders updated
+        :rtype: int
+        """
+        if not order_ids:
+            return 0
+        values = cls.summary_expressions()
+        values[cls.version] = cls.version + 1
+        query = cls.query.filter(cls.id.in_(list(order_ids)))
+        if version is not None:
+            query = query.filter(cls.version == version)
+        return query.update(values, synchronize_session=False)
+
+    @classmethod
+    def summary_expressions(cls):
+        """ Returns the SQL expressions of the summary columns, computed from the items """
+
+        def has_item(*statuses):
+            return db.session.query(OrderItem.item_id).filter(
+                OrderItem.order_id == cls.id, OrderItem.status.in_(statuses)
+            ).correlate(cls).exists()
+
+        item_count = db.session.query(func.count(OrderItem.item_id)) \
+            .filter(OrderItem.order_id == cls.id).correlate(cls).as_scalar()
+        order_status = case(
+            [(has_item(status), status) for status in ORDER_STATUS_PRECEDENCE]
+            + [(has_item("CANCELLED"), "CANCELLED")],
+            else_="PLACED")
+        return {
+            cls.total_amount: cls.total_expression(),
+            cls.item_count: item_count,
+            cls.order_status: order_status,
+        }
+
+    @classmethod
+    def bulk_create(cls, orders, batch_size=None):
+        """
+        Creates many Orders in the database in one transaction
+
+        The Orders are inserted batch_size at a time with multi-row INSERTs
+        that bypass the unit of work. On PostgreSQL the ids of a batch are
+        drawn from the id sequence first and inserted with the Orders, as
+        the rows of INSERT ... RETURNING are not guaranteed to come back in
+        the order of the VALUES. Elsewhere the Orders of a batch are
+        inserted one by one to learn their ids. All the items of a batch
+        are inserted with a single statement.
+
+        :param orders: an iterable of validated Orders that are not in the session
+        :param batch_size: the number of Orders inserted per statement
+
+        :return: the ids of the new Orders, in the order they were given
+        :rtype: list
+        """
+        batch_size = batch_size or cls.app.config["BULK_BATCH_SIZE"]
+        preallocate = db.session.get_bind().dialect.name == "postgresql"
+        order_table, item_table = cls.__table__, OrderItem.__table__
+        orders = iter(orders)
+        ids = []
+        try:
+            for batch in iter(lambda: list(islice(orders, batch_size)), []):
+                created_date = datetime.now()
+                for order in batch:
+                    order.summarize()
+                rows = [{"customer_id": order.customer_id,
+                         "created_date": created_date,
+                         "total_amount": order.total_amount,
+                         "item_count": order.item_count,
+                         "order_status": order.order_status}
+                        for order in batch]
+                if preallocate:
+                    batch_ids = [row[0] for row in db.session.execute(cls.next_ids(len(rows)))]
+                    for row, order_id in zip(rows, batch_ids):
+                        row["id"] = order_id
+                    db.session.execute(order_table.insert().values(rows))
+                else:
+                    batch_ids = [db.session.execute(order_table.insert().values(row))
+                                 .inserted_primary_key[0] for row in rows]
+                item_rows = [{"order_id": order_id,
+                              "product_id": item.product_id,
+                              "quantity": item.quantity,
+                              "price": item.price,
+                              "status": item.status}
+                             for order_id, order in zip(batch_ids, batch)
+                             for item in order.order_items]
+                if item_rows:
+                    db.session.execute(item_table.insert().values(item_rows))
+                ids.extend(batch_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.logger.info("Bulk created %d Orders", len(ids))
+        return ids
+
+    @classmethod
+    def next_ids(cls, count):
+        """ Returns a query drawing count new ids from the PostgreSQL sequence of the Orders """
+        table = '"{}"'.format(cls.__table__.name)
+        sequence = func.pg_get_serial_sequence(table, "id")
+        return select([func.nextval(sequence)]).select_from(func.generate_series(1, count))
+
+    def serialize(self, fields=None):
+        """Serializes an order into a dictionary ready to be encoded as JSON
+
+        :param fields: the names of the fields to serialize, all of them when
+                       None; other attributes are not read, so they may be
+                       left unloaded
+
+        """
+        if fields is not None:
+            return {name: self.serialize_field(name) for name in ORDER_FIELDS if name in fields}
         return {
             "id": self.id,
+            "created_date": self.created_date.isoformat() if self.created_date else None,
             "customer_id": self.customer_id,
-            "created_date": self.created_date,
+            "version": self.version,
+            "total_amount": self.total_amount,
+            "item_count": self.item_count,
+            "order_status": self.order_status,
             "order_items": [order_item.serialize() for order_item in self.order_items]
         }
 
+    def serialize_field(self, name):
+        """ Serializes a single field of an order """
+        if name == "created_date":
+            return self.created_date.isoformat() if self.created_date else None
+        if name == "order_items":
+            return [order_item.serialize() for order_item in self.order_items]
+        return getattr(self, name)
+
     def deserialize(self, data: dict):
         """
         Deserializes an Order from a dictionary
@@ -168,7 +588,6 @@ class Order(db.Model):
         return self
 
     @classmethod
-    @retry(HTTPError, delay=1, backoff=2, tries=5)
     def init_db(cls, app):
         """Initializes the database session
 
@@ -177,27 +596,467 @@ class Order(db.Model):
         """
         cls.logger.info("Initializing database")
         cls.app = app
+        cls.cache = create_cache(app.config)
+        db_retry.configure(app.config)
         db.init_app(app)
+        db.init_replicas(app.config)
         app.app_context().push()
-        db.create_all()
+        cls.create_tables()
+
+    @classmethod
+    @db_retry
+    def create_tables(cls):
+        """Creates the tables the database lacks, leaving the existing ones as they are
+
+        Every gunicorn worker does so as it starts, which is quick as the
+        new tables are empty. Adding columns and indexes to the tables that
+        exist may take longer than gunicorn lets a worker load, so it is
+        left to the upgrade-db command, see create_db(), and only logged.
+        """
+        with cls.schema_lock():
+            db.create_all()
+        columns, indexes = cls.missing_schema()
+        if columns or indexes:
+            cls.logger.warning(
+                "The database lacks %s, run 'flask upgrade-db'",
+                ", ".join(["column {}.{}".format(column.table.name, column.name)
+                           for column in columns]
+                          + ["index {}".format(index.name) for index in indexes]))
+
+    @classmethod
+    @db_retry
+    def create_db(cls):
+        """Creates the tables, columns and indexes the database lacks
+
+        Run by the upgrade-db command before the workers start. On
+        PostgreSQL it holds an advisory lock, so two upgrades or a worker
+        creating the tables take turns instead of failing on a concurrent
+        CREATE TABLE or ALTER TABLE.
+        """
+        with cls.schema_lock():
+            db.create_all()
+            cls.upgrade_db()
+
+    @classmethod
+    @contextmanager
+    def schema_lock(cls):
+        """ Holds the advisory lock of the schema on PostgreSQL, does nothing elsewhere """
+        if db.engine.dialect.name != "postgresql":
+            yield
+            return
+        with db.engine.connect() as conn:
+            # outside of a transaction, CREATE INDEX CONCURRENTLY would wait for it
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            conn.execute(select([func.pg_advisory_lock(SCHEMA_LOCK_KEY)]))
+            try:
+                yield
+            finally:
+                conn.execute(select([func.pg_advisory_unlock(SCHEMA_LOCK_KEY)]))
 
     @classmethod
-    @retry(HTTPError, delay=1, backoff=2, tries=5)
-    def all(cls):
-        """ Returns all of the Orders in the database """
+    def upgrade_db(cls):
+        """Creates the columns and indexes declared on the models that the database lacks
+
+        db.create_all() only creates missing tables, so tables created by an
+        older version of the service are brought up to date here. New
+        columns must have a server default so existing rows get a value, and
+        summary columns are then computed for every Order. On PostgreSQL the
+        indexes are built CONCURRENTLY so a live table stays writable while
+        they are built.
+        """
+        columns, indexes = cls.missing_schema()
+        for column in columns:
+            cls._add_column(column)
+        for index in indexes:
+            cls._create_index(index)
+        added = {column.name for column in columns}
+        summaries = cls.summary_expressions()
+        if added.intersection(column.key for column in summaries):
+            cls.logger.info("Computing the summary columns of every Order")
+            db.session.query(cls).update(summaries, synchronize_session=False)
+            db.session.commit()
+
+    @classmethod
+    def missing_schema(cls):
+        """Returns the columns and the indexes declared on the models that the database lacks
+
+        An index left INVALID by an interrupted CREATE INDEX CONCURRENTLY
+        counts as missing, as it is never used by the queries.
+        """
+        columns, indexes = [], []
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            columns.extend(column for column in table.columns if column.name not in existing)
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            existing.difference_update(cls._invalid_indexes(table.name))
+            indexes.extend(index for index in table.indexes if index.name not in existing)
+        return columns, indexes
+
+    @classmethod
+    def _invalid_indexes(cls, table_name):
+        """ Returns the names of the invalid indexes of a table on PostgreSQL, none elsewhere """
+        if db.engine.dialect.name != "postgresql":
+            return set()
+        rows = db.engine.execute(
+            text("SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                 "WHERE i.indrelid = CAST(:table AS regclass) AND NOT i.indisvalid"),
+            table=db.engine.dialect.identifier_preparer.quote(table_name))
+        return {name for (name,) in rows}
+
+    @classmethod
+    def _add_column(cls, column):
+        """ Adds a single column to an existing table, tolerating another worker adding it first """
+        cls.logger.info("Adding column %s.%s", column.table.name, column.name)
+        preparer = db.engine.dialect.identifier_preparer
+        try:
+            db.engine.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                preparer.format_table(column.table),
+                CreateColumn(column).compile(dialect=db.engine.dialect)))
+        except DatabaseError:
+            existing = inspect(db.engine).get_columns(column.table.name)
+            if column.name not in {other["name"] for other in existing}:
+                raise
+
+    @classmethod
+    def _create_index(cls, index):
+        """ Creates a single index, replacing an invalid one and tolerating another process """
+        cls.logger.info("Creating index %s", index.name)
+        with db.engine.connect() as conn:
+            concurrently = conn.dialect.name == "postgresql"
+            if concurrently:
+                conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                if index.name in cls._invalid_indexes(index.table.name):
+                    cls.logger.warning("Dropping invalid index %s to build it again", index.name)
+                    conn.execute("DROP INDEX CONCURRENTLY {}".format(
+                        conn.dialect.identifier_preparer.quote(index.name)))
+            index.dialect_options["postgresql"]["concurrently"] = concurrently
+            try:
+                index.create(bind=conn)
+            except DatabaseError:
+                existing = inspect(db.engine).get_indexes(index.table.name)
+                if index.name not in {other["name"] for other in existing}:
+                    raise
+            finally:
+                index.dialect_options["postgresql"]["concurrently"] = False
+
+    @classmethod
+    @db_retry
+    def all(cls, limit=None, after=None):
+        """Returns a page of the Orders in the database ordered by id
+
+        :param limit: the maximum number of Orders to return
+        :param after: only return Orders with an id greater than this one
+
+        """
         cls.logger.info("Listing all Orders")
-        return cls.query.all()
+        return cls.paginate(cls.query, limit, after)
 
     @classmethod
-    @retry(HTTPError, delay=1, backoff=2, tries=5)
-    def find(cls, order_id):
-        """ Finds a Order by it's ID """
+    @db_retry
+    def find(cls, order_id, fields=None):
+        """Finds a Order by it's ID
+
+        :param order_id: the id of the Order
+        :param fields: the fields to load, see load_options()
+
+        """
         cls.logger.info("Processing lookup for id %s ...", order_id)
-        return cls.query.get(order_id)
+        # a single order is fetched with its items in one joined SELECT
+        return cls.query.options(*cls.load_options(fields, items=joinedload)).get(order_id)
+
+    @classmethod
+    @db_retry
+    def find_version(cls, order_id):
+        """ Returns the current version of an Order, or None if it doesn't exist """
+        return db.session.query(cls.version).filter(cls.id == order_id).scalar()
 
     @classmethod
-    @retry(HTTPError, delay=1, backoff=2, tries=5)
-    def find_by_customer_id(cls, customer_id: int):
-        """Returns all of the orders with customer_id: customer_id """
+    @db_retry
+    def find_serialized(cls, order_id, fields=None):
+        """Returns a serialized Order by it's ID, reading through the cache
+
+        Every write to an Order removes it from the cache, so a cached Order
+        is only served until the next change to it or its items. A cache
+        that isn't shared only hears of the writes of its own worker, so its
+        entries are only served while their version matches the one read
+        where an uncached read would go, a replica when there are some: the
+        entry is then as fresh as that read, and no fresher. A shared cache
+        is filled from the primary instead, so a replica that lags behind a
+        write can't put the old Order back in the cache of every worker.
+        When only some fields are asked for and the Order is not cached,
+        only those fields are loaded and the cache is left alone.
+
+        :param order_id: the id of the Order
+        :param fields: the fields to serialize, all of them when None
+
+        """
+        # pylint infers the NullCache set before init_db(), which never returns an entry
+        data = cls.cache.get(order_id)  # pylint: disable=assignment-from-none
+        if data is not None and not cls.cache.shared:
+            version = cls.find_version(order_id)
+            if version != data["version"]:  # pylint: disable=unsubscriptable-object
+                cls.cache.delete(order_id)
+                if version is None:
+                    return None
+                data = None
+        if data is not None:
+            if fields is not None:
+                data = {name: value for name, value in data.items() if name in fields}
+            return data
+        if fields is not None:
+            order = cls.find(order_id, fields)
+            return order.serialize(fields) if order else None
+        if cls.cache.shared:
+            with db.primary():
+                order = cls.find(order_id)
+        else:
+            order = cls.find(order_id)
+        if not order:
+            return None
+        data = order.serialize()
+        cls.cache.set(order_id, data)
+        return data
+
+    @classmethod
+    @db_retry
+    def find_by_customer_id(cls, customer_id: int, limit=None, after=None):
+        """Returns a page of the orders with customer_id: customer_id """
         cls.logger.info("Processing customer_id query for %s ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id)
+        return cls.paginate(cls.query.filter(cls.customer_id == customer_id), limit, after)
+
+    @classmethod
+    @db_retry
+    def search(cls, limit=None, after=None, sort="id", fields=None, **filters):
+        """Returns a page of the Orders matching every filter given
+
+        :param limit: the maximum number of Orders to return
+        :param after: the sort key of the last Order of the previous page
+        :param sort: the order of the Orders, see sort_keys()
+        :param fields: the fields to load, see load_options()
+        :param filters: the filters of filter_query()
+
+        """
+        cls.logger.info("Processing search for %s ...", filters)
+        return cls.paginate(cls.filter_query(**filters), limit, after, sort, fields)
+
+    @classmethod
+    def filter_query(cls, **filters):
+        """Returns a query of the Orders matching every filter that is not None
+
+        :param filters: the filters of filter_criteria()
+
+        """
+        return cls.query.filter(*cls.filter_criteria(**filters))
+
+    @classmethod
+    def filter_criteria(cls, customer_id=None, status=None, product_id=None, order_status=None,
+                        created_from=None, created_to=None, total_min=None, total_max=None):
+        """Returns the WHERE criteria on Order of every filter that is not None
+
+        The item filters are EXISTS subqueries, so an Order is matched once
+        however many of its items match, and each of them may be matched by
+        a different item.
+
+        :param customer_id: the customer of the Orders
+        :param status: a status that one of the items has
+        :param product_id: a product that one of the items is for
+        :param order_status: the summary status of the Orders
+        :param created_from: the earliest creation date, inclusive
+        :param created_to: the latest creation date, exclusive
+        :param total_min: the lowest total of the Order, inclusive
+        :param total_max: the highest total of the Order, inclusive
+
+        """
+        criteria = []
+        if customer_id is not None:
+            criteria.append(cls.customer_id == customer_id)
+        if status is not None:
+            criteria.append(cls.order_items.any(OrderItem.status == status))
+        if product_id is not None:
+            criteria.append(cls.order_items.any(OrderItem.product_id == product_id))
+        if order_status is not None:
+            criteria.append(cls.order_status == order_status)
+        if created_from is not None:
+            criteria.append(cls.created_date >= created_from)
+        if created_to is not None:
+            criteria.append(cls.created_date < created_to)
+        if total_min is not None:
+            criteria.append(cls.total_amount >= total_min)
+        if total_max is not None:
+            criteria.append(cls.total_amount <= total_max)
+        return criteria
+
+    @classmethod
+    def total_expression(cls):
+        """ Returns the SQL expression of the total of an Order, leaving out cancelled items """
+        return db.session.query(
+            func.coalesce(func.sum(OrderItem.quantity * OrderItem.price), 0)
+        ).filter(
+            OrderItem.order_id == cls.id, OrderItem.status != "CANCELLED"
+        ).correlate(cls).as_scalar()
+
+    @classmethod
+    @db_retry
+    def stats(cls, **filters):
+        """Returns aggregate statistics of the Orders matching every filter given
+
+        Everything is computed by GROUP BY queries, over the items by status
+        and over the summary columns of the Orders by status and by day of
+        creation, so no Order is ever loaded. Revenue leaves out cancelled
+        items, like the Order total.
+
+        :param filters: the filters of filter_criteria()
+
+        """
+        cls.logger.info("Processing stats for %s ...", filters)
+        criteria = cls.filter_criteria(**filters)
+        amount = OrderItem.quantity * OrderItem.price
+        by_status = db.session.query(
+            OrderItem.status,
+            func.count(OrderItem.item_id),
+            func.coalesce(func.sum(OrderItem.quantity), 0),
+            func.coalesce(func.sum(amount), 0),
+        ).join(cls, OrderItem.order_id == cls.id).filter(*criteria) \
+            .group_by(OrderItem.status).order_by(OrderItem.status).all()
+
+        by_order_status = db.session.query(cls.order_status, func.count(cls.id)) \
+            .filter(*criteria).group_by(cls.order_status).order_by(cls.order_status).all()
+
+        day = func.date(cls.created_date)
+        daily = db.session.query(
+            day,
+            func.count(cls.id),
+            func.coalesce(func.sum(cls.item_count), 0),
+            func.coalesce(func.sum(cls.total_amount), 0),
+        ).filter(*criteria).group_by(day).order_by(day).all()
+
+        orders = sum(row[1] for row in daily)
+        items = int(sum(row[2] for row in daily))
+        revenue = float(sum(row[3] for row in daily))
+        return {
+            "orders": orders,
+            "items": items,
+            "revenue": revenue,
+            "average_order_total": revenue / orders if orders else 0.0,
+            "average_items_per_order": items / orders if orders else 0.0,
+            "orders_by_status": [
+                {"order_status": order_status, "orders": count}
+                for order_status, count in by_order_status
+            ],
+            "by_status": [
+                {"status": status, "items": count,
+                 "quantity": int(quantity), "amount": float(total)}
+                for status, count, quantity, total in by_status
+            ],
+            "daily": [
+                {"date": str(date), "orders": count, "items": item_count, "revenue": float(total)}
+                for date, count, item_count, total in daily
+            ],
+        }
+
+    @classmethod
+    def paginate(cls, query, limit=None, after=None, sort="id", fields=None):
+        """Returns one page of a query using keyset pagination
+
+        Seeking past the sort key of the last Order seen keeps every page an
+        index range scan, no matter how deep into the table the client has
+        paged. The items of the whole page are loaded with one extra SELECT
+        ... WHERE order_id IN (...) instead of one SELECT per order; a joined
+        load would multiply the rows and push the LIMIT into a subquery.
+
+        :param query: the query to paginate
+        :param limit: the maximum number of Orders in the page
+        :param after: the sort key of the last Order of the previous page
+        :param sort: the order of the Orders, see sort_keys()
+        :param fields: the fields to load, see load_options()
+
+        """
+        if limit is None:
+            limit = cls.app.config["PAGE_SIZE_DEFAULT"]
+        query = cls.seek(query, after, sort).options(*cls.load_options(fields, sort))
+        return query.limit(limit).all()
+
+    @classmethod
+    def stream(cls, after=None, sort="id", fields=None, **filters):
+        """Iterates over the matching Orders in sort order, one batch at a time
+
+        The rows are read through a server-side cursor STREAM_BATCH_SIZE at a
+        time, with the items of each batch loaded in one SELECT, so memory
+        stays flat however many Orders match.
+
+        :param after: only return Orders sorted after this sort key
+        :param sort: the order of the Orders, see sort_keys()
+        :param fields: the fields to load, see load_options()
+        :param filters: the filters of filter_query()
+
+        """
+        cls.logger.info("Streaming Orders for %s ...", filters)
+        query = cls.seek(cls.filter_query(**filters), after, sort)
+        query = query.options(*cls.load_options(fields, sort))
+        return query.yield_per(cls.app.config["STREAM_BATCH_SIZE"])
+
+    @classmethod
+    def load_options(cls, fields=None, sort="id", items=selectinload):
+        """Returns the loader options that load the given fields of Orders
+
+        The columns of the other fields are left out of the SELECT, and the
+        items are not queried at all unless order_items is asked for. The id,
+        the version and the sort columns are always loaded, as the ETags and
+        the cursors are made from them.
+
+        :param fields: the names of the fields to load, all of them when None
+        :param sort: the order the Orders are read in, see sort_keys()
+        :param items: the loader of the items when they are asked for
+
+        """
+        if fields is None:
+            return [items(cls.order_items)]
+        keys, _ = cls.sort_keys(sort)
+        columns = {"version", *(key.key for key in keys)}
+        columns.update(name for name in fields if name != "order_items")
+        return [load_only(*sorted(columns)),
+                items(cls.order_items) if "order_items" in fields else noload(cls.order_items)]
+
+    @classmethod
+    def sort_keys(cls, sort="id"):
+        """Returns the columns an order sorts on and whether it is descending
+
+        :param sort: id or one of ORDER_SORT_COLUMNS, prefixed with - for a
+                     descending order; ties are broken by id
+
+        """
+        descending = sort.startswith("-")
+        name = sort.lstrip("-")
+        if name == "id":
+            return (cls.id,), descending
+        if name not in ORDER_SORT_COLUMNS:
+            raise DataValidationError("Invalid sort: {}".format(sort))
+        return (getattr(cls, name), cls.id), descending
+
+    @classmethod
+    def sort_key(cls, order, sort="id"):
+        """ Returns the values of an Order that an order sorts on """
+        keys, _ = cls.sort_keys(sort)
+        return [getattr(order, key.key) for key in keys]
+
+    @classmethod
+    def seek(cls, query, after=None, sort="id"):
+        """Orders a query and skips the Orders up to the sort key after
+
+        :param query: the query to order
+        :param after: the sort key of the last Order seen, or just its id
+                      when sorting on id
+        :param sort: the order of the Orders, see sort_keys()
+
+        """
+        keys, descending = cls.sort_keys(sort)
+        if after is not None:
+            if not isinstance(after, (list, tuple)):
+                after = [after]
+            if len(keys) == 1:
+                key, after = keys[0], after[0]
+            else:
+                key, after = tuple_(*keys), tuple_(*after)
+            query = query.filter(key < after if descending else key > after)
+        return query.order_by(*[key.desc() if descending else key for key in keys])
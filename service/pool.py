@@ -0,0 +1,100 @@
+"""
+Module to configure the database connection pool and report on its use
+
+The pool settings are read from the DB_POOL_* settings of config.py.
+TimedQueuePool is a QueuePool that also measures how long requests wait
+for a connection, which is the first sign that the pool is too small for
+the number of threads or greenlets of a worker.
+"""
+import threading
+import time
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that counts checkouts, timeouts and the time spent waiting """
+
+    def __init__(self, creator, *args, **kwargs):
+        super().__init__(creator, *args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.wait_time_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+
+    def stats(self):
+        """ Returns the use of the pool and the time spent waiting on it """
+        with self._stats_lock:
+            checkouts = self.checkouts
+            stats = {
+                "checkouts": checkouts,
+                "timeouts": self.timeouts,
+                "wait_time": round(self.wait_time, 6),
+                "wait_time_avg": round(self.wait_time / checkouts, 6) if checkouts else 0.0,
+                "wait_time_max": round(self.wait_time_max, 6),
+            }
+        stats.update({
+            "pool": type(self).__name__,
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "max_overflow": self._max_overflow,
+        })
+        return stats
+
+
+def pool_options(config):
+    """
+    Returns the create_engine() options of the connection pool
+
+    :param config: the configuration of the Flask app
+
+    """
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+
+
+def pool_stats(engine):
+    """ Returns the stats of the pool of an engine, whatever its class """
+    pool = engine.pool
+    if isinstance(pool, TimedQueuePool):
+        return pool.stats()
+    return {"pool": type(pool).__name__, "status": pool.status()}
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy with the connection pool configured from the app config
+
+    SQLite keeps the pools Flask-SQLAlchemy picks for it, as its connections
+    can't be shared between threads.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        if not sa_url.drivername.startswith("sqlite"):
+            options.update(pool_options(app.config))
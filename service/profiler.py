@@ -0,0 +1,73 @@
+"""
+Module to profile single requests on demand
+
+A request that carries the PROFILE_SECRET in its X-Profile header runs
+under cProfile, from the WSGI call to the last byte of its body, so the
+profile covers the resources, the serialization and the SQLAlchemy calls
+alike. The profile is stored in PROFILE_DIR as a pstats dump, which
+snakeviz, gprof2dot or flameprof turn into call graphs and flame graphs,
+and its file name is sent back in the X-Profile-Dump header. Profiling is
+off while PROFILE_SECRET is empty.
+"""
+import cProfile
+import hmac
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger("flask.app")
+
+
+class ProfilerMiddleware:
+    """
+    WSGI middleware running the requests that ask for it under cProfile
+
+    The body of a profiled response is read in full before it is sent, so
+    a streamed response is profiled to its end.
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        if not self.is_requested(environ):
+            return self.app(environ, start_response)
+        name = self.dump_name(environ)
+
+        def start_profiled_response(status, headers, exc_info=None):
+            headers.append(("X-Profile-Dump", name))
+            return start_response(status, headers, exc_info)
+
+        profile = cProfile.Profile()
+        body = profile.runcall(self.app, environ, start_profiled_response)
+        try:
+            chunks = profile.runcall(list, body)
+        finally:
+            if hasattr(body, "close"):
+                profile.runcall(body.close)
+        directory = self.config["PROFILE_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(os.path.join(directory, name))
+        logger.info("Stored the profile of %s %s in %s", environ["REQUEST_METHOD"],
+                    environ.get("PATH_INFO", "/"), name)
+        return chunks
+
+    def is_requested(self, environ):
+        """ Returns True if the request carries the profiling secret """
+        secret = self.config["PROFILE_SECRET"]
+        token = environ.get("HTTP_X_PROFILE")
+        return bool(secret and token
+                    and hmac.compare_digest(token.encode("utf-8"), secret.encode("utf-8")))
+
+    @staticmethod
+    def dump_name(environ):
+        """
+        Returns a file name for the profile of a request
+
+        Such as 1605000000123-42-GET-orders-1.prof
+        """
+        path = re.sub(r"[^A-Za-z0-9]+", "-", environ.get("PATH_INFO", "/")).strip("-")
+        return "{}-{}-{}-{}.prof".format(int(time.time() * 1000), os.getpid(),
+                                         environ["REQUEST_METHOD"], path or "root")
@@ -0,0 +1,134 @@
+"""
+Module to retry database work that failed for a transient reason
+
+A transient failure is one the same work may not hit again: a connection
+dropped by a failover, a deadlock, a serialization failure or a locked
+database. The session is rolled back before each new attempt, attempts
+are spaced by a jittered backoff of a few milliseconds, and no attempt
+starts once the deadline of the call would be passed.
+"""
+import functools
+import random
+import threading
+import time
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+# SQLSTATE codes of PostgreSQL that are worth another attempt: serialization
+# failure, deadlock, connection exceptions and server shutdowns
+TRANSIENT_SQLSTATES = ("40001", "40P01")
+TRANSIENT_SQLSTATE_CLASSES = ("08", "57P")
+
+# Messages of the drivers without SQLSTATE codes, such as SQLite, for a lock
+# or a busy database that another attempt may find released
+TRANSIENT_MESSAGES = ("database is locked", "database table is locked", "database is busy",
+                      "lock wait timeout exceeded", "deadlock found")
+
+
+def is_transient(error):
+    """ Returns True if the database work that raised error may be tried again """
+    if not isinstance(error, DBAPIError):
+        return False
+    if error.connection_invalidated:
+        return True
+    code = getattr(error.orig, "pgcode", None)
+    if code:
+        return code in TRANSIENT_SQLSTATES or code.startswith(TRANSIENT_SQLSTATE_CLASSES)
+    if not isinstance(error, OperationalError):
+        return False
+    message = str(error.orig).lower()
+    return any(transient in message for transient in TRANSIENT_MESSAGES)
+
+
+class RetryPolicy:
+    """
+    A decorator that retries database work on transient failures
+
+    Delays are in seconds. The n-th retry waits a random time up to
+    base_delay * 2 ** n, capped at max_delay. Calls made while another
+    decorated call is running are not retried on their own, the outermost
+    call retries the whole work instead.
+    """
+
+    def __init__(self, rollback, attempts=4, base_delay=0.02, max_delay=0.5, deadline=2.0,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.rollback = rollback
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.sleep = sleep
+        self.clock = clock
+        self.retries = 0
+        self.recovered = 0
+        self.exhausted = 0
+        self.retries_by_operation = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, config):
+        """
+        Reads the policy from the DB_RETRY_* settings
+
+        :param config: the configuration of the Flask app
+
+        """
+        self.attempts = config["DB_RETRY_ATTEMPTS"]
+        self.base_delay = config["DB_RETRY_BASE_DELAY_MS"] / 1000
+        self.max_delay = config["DB_RETRY_MAX_DELAY_MS"] / 1000
+        self.deadline = config["DB_RETRY_DEADLINE_MS"] / 1000
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if getattr(self._local, "active", False):
+                return function(*args, **kwargs)
+            self._local.active = True
+            try:
+                return self._call(function.__qualname__, function, args, kwargs)
+            finally:
+                self._local.active = False
+        return wrapper
+
+    def _call(self, operation, function, args, kwargs):
+        """ Calls function until it succeeds, fails for good or runs out of time """
+        give_up_at = self.clock() + self.deadline
+        attempt = 1
+        while True:
+            try:
+                result = function(*args, **kwargs)
+            except DBAPIError as error:
+                delay = self.delay(attempt)
+                if (not is_transient(error) or attempt >= self.attempts
+                        or self.clock() + delay > give_up_at):
+                    if attempt > 1:
+                        self._count("exhausted")
+                    raise
+                self.rollback()
+                self._count("retries", operation)
+                self.sleep(delay)
+                attempt += 1
+                continue
+            if attempt > 1:
+                self._count("recovered")
+            return result
+
+    def delay(self, attempt):
+        """ Returns the jittered time to wait before the attempt after this one """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _count(self, counter, operation=None):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            if operation:
+                retries = self.retries_by_operation.get(operation, 0)
+                self.retries_by_operation[operation] = retries + 1
+
+    def stats(self):
+        """ Returns the number of retries and of calls that recovered or gave up """
+        with self._lock:
+            return {
+                "retries": self.retries,
+                "recovered": self.recovered,
+                "exhausted": self.exhausted,
+                "retries_by_operation": dict(self.retries_by_operation),
+            }
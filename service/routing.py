@@ -0,0 +1,169 @@
+"""
+Module to route the reads of safe requests to read replicas
+
+When DATABASE_REPLICA_URIS lists replicas, the session of a GET or HEAD
+request sends its queries to one of them, picked round-robin among those
+that passed their last health check. Everything else goes to the primary:
+the queries of other requests, every write, and every query that follows
+a write in the same request, so a request always reads its own writes.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.dml import UpdateBase
+from flask_sqlalchemy import SignallingSession
+from .pool import PooledSQLAlchemy, pool_options
+
+logger = logging.getLogger("flask.app")
+
+
+class Replica:
+    """ A read replica and the result of its last health check """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = None
+        self.reads = 0
+
+
+class ReplicaSet:
+    """
+    The read replicas of the database, handed out round-robin
+
+    A replica is checked with a SELECT 1 when it is picked and its last
+    check is older than check_interval seconds, and as soon as one of its
+    connections fails. Replicas that failed their check are skipped until
+    a later check passes.
+    """
+
+    def __init__(self, engines=(), check_interval=5, clock=time.monotonic):
+        self.replicas = [Replica(engine) for engine in engines]
+        self.check_interval = check_interval
+        self.clock = clock
+        self._next = 0
+        self._lock = threading.Lock()
+        for replica in self.replicas:
+            event.listen(replica.engine, "handle_error", self._on_error)
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def choose(self):
+        """ Returns the engine of the next healthy replica, or None if there is none """
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.replicas), 1)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if self._is_healthy(replica):
+                replica.reads += 1
+                return replica.engine
+        return None
+
+    def is_healthy(self, engine):
+        """ Returns True if engine belongs to a replica that is not known to be down """
+        return any(replica.engine is engine and replica.healthy for replica in self.replicas)
+
+    def _is_healthy(self, replica):
+        now = self.clock()
+        if replica.checked_at is None or now - replica.checked_at >= self.check_interval:
+            replica.checked_at = now
+            replica.healthy = self.check(replica.engine)
+        return replica.healthy
+
+    @staticmethod
+    def check(engine):
+        """ Returns True if a connection to engine answers a query """
+        try:
+            with engine.connect() as conn:
+                conn.execute("SELECT 1")
+            return True
+        except DBAPIError as error:
+            logger.warning("Read replica %r failed its health check: %s", engine.url, error)
+            return False
+
+    def _on_error(self, context):
+        """ Marks a replica down as soon as one of its connections is lost """
+        if context.is_disconnect:
+            for replica in self.replicas:
+                if replica.engine is context.engine:
+                    replica.healthy = False
+                    replica.checked_at = self.clock()
+
+    def dispose(self):
+        """ Closes the connections of every replica """
+        for replica in self.replicas:
+            event.remove(replica.engine, "handle_error", self._on_error)
+            replica.engine.dispose()
+
+    def stats(self):
+        """ Returns the health and the number of reads of each replica """
+        return [{
+            "url": repr(replica.engine.url),
+            "healthy": replica.healthy,
+            "reads": replica.reads,
+        } for replica in self.replicas]
+
+
+class RoutingSession(SignallingSession):
+    """ A session that reads from a replica until it writes """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase) or self._flushing:
+            self.info["pinned"] = True
+        if (self.info.get("replica") and not self.info.get("pinned")
+                and not self.info.get("primary") and self.db.replicas):
+            engine = self.info.get("replica_engine")
+            if engine is None or not self.db.replicas.is_healthy(engine):
+                engine = self.db.replicas.choose()
+                self.info["replica_engine"] = engine
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(PooledSQLAlchemy):
+    """ SQLAlchemy with a RoutingSession and the read replicas of the app config """
+
+    def __init__(self, *args, **kwargs):
+        self.replicas = ReplicaSet()
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_replicas(self, config):
+        """
+        Creates an engine for each replica in DATABASE_REPLICA_URIS
+
+        :param config: the configuration of the Flask app
+
+        """
+        self.replicas.dispose()
+        uris = [uri.strip() for uri in config["DATABASE_REPLICA_URIS"].split(",") if uri.strip()]
+        self.replicas = ReplicaSet(
+            [create_engine(uri, **({} if uri.startswith("sqlite") else pool_options(config)))
+             for uri in uris],
+            check_interval=config["DATABASE_REPLICA_CHECK_INTERVAL"])
+
+    def route_reads(self, enabled):
+        """ Sends the reads of the current session to a replica until it writes """
+        self.session.info.update(replica=enabled, pinned=False, replica_engine=None)
+
+    @contextmanager
+    def primary(self):
+        """ Sends the queries made inside the block to the primary """
+        previous = self.session.info.get("primary", False)
+        self.session.info["primary"] = True
+        try:
+            yield
+        finally:
+            self.session.info["primary"] = previous
@@ -0,0 +1,28 @@
+"""
+Module to encode response bodies as JSON in one pass
+
+The dicts built by Order.serialize() are already in their JSON form, so
+they are encoded as they are, without marshalling them through the API
+models again. orjson encodes them when it is installed, the json module of
+the standard library otherwise.
+"""
+import json
+from flask import Response
+from flask_api import status
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+def dumps(data):
+    """ Encodes data as compact JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(data, code=status.HTTP_200_OK, headers=None):
+    """ Returns a Response with data encoded as JSON """
+    return Response(dumps(data), status=code, headers=headers, mimetype="application/json")
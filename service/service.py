@@ -1,10 +1,22 @@
 """ Module to define the Rest APIs """
-from flask import jsonify, request, make_response, abort
+import base64
+import hashlib
+import json
+from datetime import datetime
+from flask import jsonify, request, make_response, abort, Response, stream_with_context
 from flask_api import status
-from flask_restx import Api, Resource, fields, reqparse
+from flask_restx import Api, Resource, fields, inputs, marshal, reqparse
 from werkzeug.exceptions import NotFound
-
-from .models import Order, OrderItem, DataValidationError
+from werkzeug.http import quote_etag
+
+from .models import (db, db_retry, Order, OrderItem, DataValidationError, ConcurrencyError,
+                     ITEM_STATUSES, ORDER_FIELDS, ORDER_SORT_COLUMNS, ORDER_TRANSITIONS)
+from .compression import compress_response
+from .metrics import RequestMetrics
+from .pool import pool_stats
+from .profiler import ProfilerMiddleware
+from .slowlog import SlowLog
+from .serialization import dumps, json_response
 from . import app
 
 
@@ -18,6 +30,94 @@ def index():
     return app.send_static_file('index.html')
 
 
+######################################################################
+# GET CACHE STATISTICS
+######################################################################
+@app.route('/cache/stats')
+def cache_stats():
+    """ Returns the hit, miss and eviction counters of the order cache """
+    return jsonify(Order.cache.stats()), status.HTTP_200_OK
+
+
+######################################################################
+# GET DATABASE POOL STATISTICS
+######################################################################
+@app.route('/pool/stats')
+def database_pool_stats():
+    """ Returns the connections in use and the time spent waiting for one """
+    return jsonify(pool_stats(db.engine)), status.HTTP_200_OK
+
+
+######################################################################
+# GET DATABASE RETRY STATISTICS
+######################################################################
+@app.route('/retry/stats')
+def retry_stats():
+    """ Returns the retries of database work that failed for a transient reason """
+    return jsonify(db_retry.stats()), status.HTTP_200_OK
+
+
+######################################################################
+# GET READ REPLICA STATISTICS
+######################################################################
+@app.route('/replicas/stats')
+def replica_stats():
+    """ Returns the health and the number of reads of each read replica """
+    return jsonify(db.replicas.stats()), status.HTTP_200_OK
+
+
+######################################################################
+# GET PROMETHEUS METRICS
+######################################################################
+request_metrics = RequestMetrics()
+request_metrics.init_app(app)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """ Returns the latency, status codes and database work of the requests """
+    body, content_type = request_metrics.export()
+    return Response(body, status=status.HTTP_200_OK, content_type=content_type)
+
+
+######################################################################
+# LOG THE SLOW REQUESTS
+######################################################################
+slow_log = SlowLog()
+slow_log.init_app(app)
+
+
+######################################################################
+# PROFILE THE REQUESTS THAT CARRY THE PROFILING SECRET
+######################################################################
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app.config)
+
+
+######################################################################
+# ROUTE THE READS OF SAFE REQUESTS TO THE READ REPLICAS
+######################################################################
+@app.before_request
+def route_reads():
+    """ Reads of GET and HEAD requests go to a replica until they write """
+    db.route_reads(request.method in ("GET", "HEAD"))
+
+
+@app.teardown_request
+def stop_routing_reads(exc):  # pylint: disable=unused-argument
+    """ Sends the queries made outside of a request to the primary """
+    db.route_reads(False)
+
+
+######################################################################
+# COMPRESS THE RESPONSES
+######################################################################
+@app.after_request
+def compress(response):
+    """ Compresses the JSON responses for the clients that accept gzip or brotli """
+    return compress_response(response, request.accept_encodings,
+                             app.config["COMPRESS_MIN_SIZE"], app.config["COMPRESS_LEVEL"])
+
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -64,7 +164,9 @@ create_model = api.model('Order', {
 
 order_update_model = api.model('OrderUpdateModel', {
     'customer_id': fields.Integer(required=True,
-                                  description='The customer id of the Order')
+                                  description='The customer id of the Order'),
+    'version': fields.Integer(required=False,
+                              description='The version of the Order the update is based on')
 })
 
 order_model = api.model('Order', {
@@ -72,22 +174,161 @@ order_model = api.model('Order', {
     'created_date': fields.DateTime(required=False, description='The date at which order was created'),
     'customer_id': fields.Integer(required=True,
                                   description='The customer id of the Order'),
+    'version': fields.Integer(readOnly=True,
+                              description='The version of the Order, bumped on every change'),
+    'total_amount': fields.Float(readOnly=True,
+                                 description='The price times quantity of the items not cancelled'),
+    'item_count': fields.Integer(readOnly=True, description='The number of items in the Order'),
+    'order_status': fields.String(readOnly=True, enum=list(ITEM_STATUSES),
+                                  description='The status of the least advanced item not cancelled,'
+                                              ' or CANCELLED when every item is'),
     'order_items': fields.List(fields.Nested(item_model, required=True), required=True,
                                description='The items in the Order')
 })
 
+bulk_result_model = api.model('BulkResult', {
+    'index': fields.Integer(description='The position of the Order in the request'),
+    'status': fields.Integer(description='The HTTP status for this Order'),
+    'id': fields.Integer(description='The id of the created Order'),
+    'error': fields.String(description='Why the Order was rejected'),
+})
+
+bulk_report_model = api.model('BulkReport', {
+    'created': fields.Integer(description='The number of Orders created'),
+    'failed': fields.Integer(description='The number of Orders rejected'),
+    'results': fields.List(fields.Nested(bulk_result_model, skip_none=True),
+                           description='The outcome for each Order'),
+})
+
+bulk_status_model = api.model('BulkStatus', {
+    'status': fields.String(required=True, enum=['SHIPPED', 'DELIVERED', 'CANCELLED'],
+                            description='The status to move the Orders or items to'),
+    'order_ids': fields.List(fields.Integer, description='The ids of the Orders to move'),
+    'item_ids': fields.List(fields.Integer, description='The ids of the items to move'),
+})
+
+bulk_status_result_model = api.model('BulkStatusResult', {
+    'id': fields.Integer(description='The id of the Order or item'),
+    'status': fields.Integer(description='The HTTP status for this Order or item'),
+    'error': fields.String(description='Why the Order or item was not moved'),
+})
+
+bulk_status_report_model = api.model('BulkStatusReport', {
+    'updated': fields.Integer(description='The number of Orders or items moved'),
+    'failed': fields.Integer(description='The number of Orders or items not moved'),
+    'results': fields.List(fields.Nested(bulk_status_result_model, skip_none=True),
+                           description='The outcome for each id'),
+})
+
+stats_status_model = api.model('StatsByStatus', {
+    'status': fields.String(description='The status of the items'),
+    'items': fields.Integer(description='The number of items in this status'),
+    'quantity': fields.Integer(description='The units ordered by these items'),
+    'amount': fields.Float(description='The price times quantity of these items'),
+})
+
+stats_day_model = api.model('StatsByDay', {
+    'date': fields.String(description='The day the Orders were created, as YYYY-MM-DD'),
+    'orders': fields.Integer(description='The number of Orders created that day'),
+    'items': fields.Integer(description='The number of items of these Orders'),
+    'revenue': fields.Float(description='The total of these Orders'),
+})
+
+stats_order_status_model = api.model('StatsByOrderStatus', {
+    'order_status': fields.String(description='The summary status of the Orders'),
+    'orders': fields.Integer(description='The number of Orders in this status'),
+})
+
+stats_model = api.model('OrderStats', {
+    'orders': fields.Integer(description='The number of matching Orders'),
+    'items': fields.Integer(description='The number of items of these Orders'),
+    'revenue': fields.Float(description='The total of these Orders, leaving out cancelled items'),
+    'average_order_total': fields.Float(description='The revenue per Order'),
+    'average_items_per_order': fields.Float(description='The items per Order'),
+    'orders_by_status': fields.List(fields.Nested(stats_order_status_model),
+                                    description='The Orders by summary status'),
+    'by_status': fields.List(fields.Nested(stats_status_model),
+                             description='The items of these Orders by status'),
+    'daily': fields.List(fields.Nested(stats_day_model),
+                         description='The Orders by day of creation'),
+})
+
+
+def local_datetime(value):
+    """ Parses an ISO 8601 date or time into the naive local time kept in created_date """
+    value = inputs.datetime_from_iso8601(value)
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+
+local_datetime.__schema__ = {'type': 'string', 'format': 'date-time'}
+
+# the query string arguments that filter the Orders listed or summarized
+ORDER_FILTERS = ('customer_id', 'status', 'product_id', 'order_status', 'created_from',
+                 'created_to', 'total_min', 'total_max')
+
+# the orders the Orders may be listed in
+ORDER_SORTS = ['id', '-id'] + [prefix + name for name in ORDER_SORT_COLUMNS for prefix in ('', '-')]
+
+filter_args = reqparse.RequestParser()
+filter_args.add_argument('customer_id', type=int, required=False, location='args',
+                         help='List Orders by Customer id')
+filter_args.add_argument('status', type=str, required=False, location='args',
+                         choices=ITEM_STATUSES,
+                         help='List Orders with an item in this status')
+filter_args.add_argument('product_id', type=int, required=False, location='args',
+                         help='List Orders with an item for this product')
+filter_args.add_argument('order_status', type=str, required=False, location='args',
+                         choices=ITEM_STATUSES,
+                         help='List Orders with this summary status')
+filter_args.add_argument('created_from', type=local_datetime, required=False, location='args',
+                         help='List Orders created at or after this ISO 8601 date or time')
+filter_args.add_argument('created_to', type=local_datetime, required=False, location='args',
+                         help='List Orders created before this ISO 8601 date or time')
+filter_args.add_argument('total_min', type=float, required=False, location='args',
+                         help='List Orders with a total of at least this amount')
+filter_args.add_argument('total_max', type=float, required=False, location='args',
+                         help='List Orders with a total of at most this amount')
+
+# the query string arguments that narrow the fields of the returned Orders
+projection_args = reqparse.RequestParser()
+projection_args.add_argument('fields', type=str, required=False, location='args',
+                             help='Comma separated fields of the Orders to return: '
+                                  + ', '.join(ORDER_FIELDS))
+projection_args.add_argument('include_items', type=inputs.boolean, required=False, location='args',
+                             help='Return the items of the Orders, or leave them out with false')
+
 # query string arguments
-order_args = reqparse.RequestParser()
-order_args.add_argument('customer_id', type=int, required=False, help='List Orders by Customer id')
+order_args = filter_args.copy()
+for projection_arg in projection_args.args:
+    order_args.add_argument(projection_arg)
+order_args.add_argument('sort', type=str, required=False, location='args', default='id',
+                        choices=ORDER_SORTS,
+                        help='Sort the Orders on this column, descending when prefixed with -')
+order_args.add_argument('limit', type=int, required=False, location='args',
+                        help='Maximum number of Orders in the page')
+order_args.add_argument('after', type=str, required=False, location='args',
+                        help='Cursor returned with the previous page')
+order_args.add_argument('stream', type=inputs.boolean, required=False, location='args',
+                        help='Stream every matching Order as a chunked JSON array')
 
 
 ######################################################################
 # Error Handlers
 ######################################################################
+# the handlers of the errors raised by the resources are registered on the
+# api too, Flask-RESTX answers 500 to them unless it has handlers of its own
+@api.errorhandler(DataValidationError)
 @app.errorhandler(DataValidationError)
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
-    return bad_request(error)
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        dict(status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message),
+        status.HTTP_400_BAD_REQUEST,
+    )
 
 
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
@@ -103,6 +344,18 @@ def bad_request(error):
     )
 
 
+@api.errorhandler(ConcurrencyError)
+@app.errorhandler(ConcurrencyError)
+def request_conflict_error(error):
+    """ Handles Orders changed by another request with 409_CONFLICT """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        dict(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """ Handles resources not found with 404_NOT_FOUND """
@@ -143,8 +396,7 @@ class OrderCollection(Resource):
     @api.doc('create_order')
     @api.expect(create_model)
     @api.response(400, 'Bad Request')
-    @api.response(201, 'Order created successfully')
-    @api.marshal_with(order_model, code=201)
+    @api.response(201, 'Order created successfully', order_model)
     def post(self):
         """
         This endpoint will create an order based the data in the body that is posted
@@ -161,26 +413,190 @@ class OrderCollection(Resource):
         message = order.serialize()
         location_url = api.url_for(OrderResource, order_id=order.id, _external=True)
         app.logger.info('Created Order with id: {}'.format(order.id))
-        return message, status.HTTP_201_CREATED, {"Location": location_url}
+        return json_response(message, status.HTTP_201_CREATED, {"Location": location_url})
 
     # ------------------------------------------------------------------
     # LIST ALL ORDERS
     # ------------------------------------------------------------------
     @api.doc('list_orders')
     @api.expect(order_args, validate=True)
-    @api.marshal_with(order_model, code=200)
+    @api.response(200, 'Success', [order_model])
+    @api.produces(['application/json', 'application/x-ndjson'])
     def get(self):
-        """ Returns all of the Orders """
+        """
+        Returns a page of the Orders
+
+        Orders are returned in id order. When more Orders are available the
+        cursor of the next page is sent in the Link and X-Next-Cursor headers.
+        Every matching Order is streamed instead when the request asks for
+        stream=true or accepts application/x-ndjson. The filters combine, an
+        Order is listed only if it matches all of them. The fields argument
+        narrows the Orders to the listed fields, include_items=false leaves
+        out their items.
+        """
         app.logger.info("Request for order list")
-        customer_id = request.args.get("customer_id")
-        if customer_id:
-            orders = Order.find_by_customer_id(customer_id)
+        args = order_args.parse_args()
+        sort = args["sort"]
+        after = decode_cursor(args["after"], sort) if args["after"] else None
+        fields = get_fields(args)
+        filters = {name: args[name] for name in ORDER_FILTERS}
+        if args["stream"] or wants_ndjson():
+            orders = Order.stream(after=after, sort=sort, fields=fields, **filters)
+            return stream_orders(orders, ndjson=wants_ndjson(), fields=fields)
+
+        limit = get_page_limit(args["limit"])
+        # fetch one extra order to find out if there is a next page
+        orders = Order.search(limit=limit + 1, after=after, sort=sort, fields=fields, **filters)
+
+        headers = {}
+        if len(orders) > limit:
+            orders = orders[:limit]
+            cursor = encode_cursor(Order.sort_key(orders[-1], sort))
+            next_args = {key: value for key, value in request.args.items() if key != "after"}
+            next_url = api.url_for(OrderCollection, after=cursor, _external=True, **next_args)
+            headers["Link"] = '<{}>; rel="next"'.format(next_url)
+            headers["X-Next-Cursor"] = cursor
+
+        # the page is unchanged if the same Orders are at the same versions
+        etag = hash_etag([[[order.id, order.version] for order in orders],
+                          headers.get("X-Next-Cursor")] + ([sorted(fields)] if fields else []))
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        results = [order.serialize(fields) for order in orders]
+        headers["ETag"] = quote_etag(etag)
+        app.logger.info("Returning %d orders", len(results))
+        return json_response(results, status.HTTP_200_OK, headers)
+
+
+######################################################################
+#  PATH: /orders/stats
+######################################################################
+@api.route('/orders/stats', strict_slashes=False)
+class OrderStatsResource(Resource):
+    """ Handles aggregate statistics of the Orders """
+
+    @api.doc('get_order_stats')
+    @api.expect(filter_args, validate=True)
+    @api.marshal_with(stats_model)
+    def get(self):
+        """
+        Returns the counts, revenue and daily series of the matching Orders
+
+        Takes the same filters as listing the Orders, such as created_from
+        and created_to for the date range and customer_id for one customer.
+        """
+        app.logger.info("Request for order stats")
+        args = filter_args.parse_args()
+        return Order.stats(**{name: args[name] for name in ORDER_FILTERS}), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders/bulk
+######################################################################
+@api.route('/orders/bulk', strict_slashes=False)
+class OrderBulkCollection(Resource):
+    """ Handles creating many Orders in one request """
+
+    @api.doc('create_orders_bulk')
+    @api.expect([create_model])
+    @api.response(400, 'Bad Request')
+    @api.response(207, 'Some Orders were rejected', bulk_report_model)
+    @api.response(201, 'Orders created successfully', bulk_report_model)
+    def post(self):
+        """
+        Create many Orders at once
+
+        The body is either a JSON array of Orders or one Order per line as
+        application/x-ndjson. Every Order is validated like a single create;
+        the valid ones are inserted together in one transaction and the
+        response reports the outcome for each Order by position.
+        """
+        app.logger.info("Request to create orders in bulk")
+        check_content_type("application/json", "application/x-ndjson")
+        results = []
+        created_indexes = []
+
+        def valid_orders():
+            for index, data in enumerate(read_bulk_payload()):
+                if index >= app.config["BULK_MAX_ORDERS"]:
+                    raise DataValidationError(
+                        "Too many Orders: at most {} per request".format(
+                            app.config["BULK_MAX_ORDERS"]))
+                order = Order()
+                try:
+                    if isinstance(data, DataValidationError):
+                        raise data
+                    order.deserialize(data)
+                except DataValidationError as dataValidationError:
+                    results.append({"index": index, "status": status.HTTP_400_BAD_REQUEST,
+                                    "error": str(dataValidationError)})
+                    continue
+                created_indexes.append(index)
+                yield order
+
+        ids = Order.bulk_create(valid_orders())
+        results.extend({"index": index, "status": status.HTTP_201_CREATED, "id": order_id}
+                       for index, order_id in zip(created_indexes, ids))
+        results.sort(key=lambda result: result["index"])
+        report = {"created": len(ids), "failed": len(results) - len(ids), "results": results}
+        app.logger.info("Created %d orders in bulk, rejected %d",
+                        report["created"], report["failed"])
+        if not ids:
+            code = status.HTTP_400_BAD_REQUEST
+        elif report["failed"]:
+            code = status.HTTP_207_MULTI_STATUS
         else:
-            orders = Order.all()
+            code = status.HTTP_201_CREATED
+        return marshal(report, bulk_report_model), code
 
-        results = [order.serialize() for order in orders]
-        app.logger.info("Returning %d orders", len(results))
-        return results, status.HTTP_200_OK
+
+######################################################################
+#  PATH: /orders/bulk/status
+######################################################################
+@api.route('/orders/bulk/status', strict_slashes=False)
+class OrderBulkStatusResource(Resource):
+    """ Handles moving many Orders or items to a new status in one request """
+
+    @api.doc('update_status_bulk')
+    @api.expect(bulk_status_model)
+    @api.response(400, 'Bad Request')
+    @api.response(207, 'Some Orders or items were not moved', bulk_status_report_model)
+    @api.response(200, 'Orders or items moved successfully', bulk_status_report_model)
+    def put(self):
+        """
+        Move many Orders or items to a new status at once
+
+        The body names the target status and either order_ids or item_ids.
+        The same rules as the single Order and item endpoints apply; every
+        eligible Order or item is moved with one UPDATE in one transaction
+        and the response reports the outcome for each id.
+        """
+        app.logger.info("Request to update statuses in bulk")
+        check_content_type("application/json")
+        new_status, model, ids = get_bulk_status_request(request.get_json())
+        outcomes = model.bulk_transition(ids, new_status)
+
+        results = []
+        for entity_id in ids:
+            if entity_id not in outcomes:
+                results.append({"id": entity_id, "status": status.HTTP_404_NOT_FOUND,
+                                "error": "{} with id '{}' was not found.".format(
+                                    "Order" if model is Order else "Item", entity_id)})
+            elif outcomes[entity_id]:
+                results.append({"id": entity_id, "status": status.HTTP_400_BAD_REQUEST,
+                                "error": outcomes[entity_id]})
+            else:
+                results.append({"id": entity_id, "status": status.HTTP_200_OK})
+        updated = sum(1 for result in results if result["status"] == status.HTTP_200_OK)
+        report = {"updated": updated, "failed": len(results) - updated, "results": results}
+        app.logger.info("Moved %d of %d to %s in bulk", updated, len(results), new_status)
+        if not updated:
+            code = status.HTTP_400_BAD_REQUEST
+        elif report["failed"]:
+            code = status.HTTP_207_MULTI_STATUS
+        else:
+            code = status.HTTP_200_OK
+        return marshal(report, bulk_status_report_model), code
 
 
 ######################################################################
@@ -202,18 +618,30 @@ class OrderResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_orders')
     @api.response(404, 'Order not found')
-    @api.marshal_with(order_model)
+    @api.response(304, 'Order not modified')
+    @api.response(200, 'Success', order_model)
+    @api.expect(projection_args, validate=True)
     def get(self, order_id):
         """
         Retrieve a single Order
 
-        This endpoint will return a Order based on it's id
+        This endpoint will return a Order based on it's id. The fields
+        argument narrows it to the listed fields, include_items=false leaves
+        out its items.
         """
         app.logger.info("Request for order with id: %s", order_id)
-        order = Order.find(order_id)
+        fields = get_fields(projection_args.parse_args())
+        # the id and version are always read, they make up the ETag
+        order = Order.find_serialized(
+            order_id, None if fields is None else fields | {"id", "version"})
         if not order:
             api.abort(status.HTTP_404_NOT_FOUND, "Order was not found.")
-        return order.serialize(), status.HTTP_200_OK
+        etag = order_etag(order, fields)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        if fields is not None:
+            order = {name: value for name, value in order.items() if name in fields}
+        return json_response(order, status.HTTP_200_OK, {"ETag": quote_etag(etag)})
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ORDER
@@ -222,27 +650,30 @@ class OrderResource(Resource):
     @api.response(404, 'Order not found')
     @api.response(400, 'The posted Order data was not valid')
     @api.expect(order_update_model)
-    @api.marshal_with(order_model)
+    @api.response(200, 'Success', order_model)
     def put(self, order_id):
         """
         Update an Order
         This endpoint will update an Order based the body that is posted
         """
         app.logger.info("Request to update order with id: %s", order_id)
+        version = check_if_match(order_id)
         check_content_type("application/json")
         order = Order.find(order_id)
         if not order:
             api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id))
+        check_version(order, version, get_version_from_request(api.payload))
         order.customer_id = get_customer_id_from_request(api.payload)
         order.update()
-        return order.serialize(), status.HTTP_200_OK
+        return order_response(order.serialize())
 
     # ------------------------------------------------------------------
     # DELETE AN ORDER
     # ------------------------------------------------------------------
     @api.doc('delete_orders')
     @api.response(404, 'Order not found')
-    @api.marshal_with(order_model)
+    @api.response(409, 'Order was changed by another request')
+    @api.response(204, 'Order deleted')
     def delete(self, order_id):
         """
         Delete an Order
@@ -277,17 +708,19 @@ class OrderItemResource(Resource):
     @api.response(404, 'Order not found')
     @api.response(400, 'The posted Order data was not valid')
     @api.expect(item_model)
-    @api.marshal_with(order_model)
+    @api.response(200, 'Success', order_model)
     def put(self, order_id, item_id):
         """
         Update an Order Item
         This endpoint will update an Order item based the body that is posted
         """
         app.logger.info("Request to update order with id: %s", order_id)
+        version = check_if_match(order_id)
         check_content_type("application/json")
         order = Order.find(order_id)
         if not order:
             api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id))
+        check_version(order, version)
         order_item_found = False
 
         new_order_item = OrderItem()
@@ -305,7 +738,15 @@ class OrderItemResource(Resource):
             api.abort(status.HTTP_404_NOT_FOUND, "Item with id '{}' was not found inside order.".format(item_id))
         order.update()
         app.logger.info("Order with ID [%s] updated.", order_id)
-        return order.serialize(), status.HTTP_200_OK
+        return order_response(order.serialize())
+
+
+def get_version_from_request(json):
+    """ Helper function to get the optional version the client last read from the request """
+    version = json.get("version") if isinstance(json, dict) else None
+    if version is not None and (not isinstance(version, int) or isinstance(version, bool)):
+        raise DataValidationError("Invalid version provided for update")
+    return version
 
 
 def get_customer_id_from_request(json):
@@ -329,27 +770,13 @@ class CancelOrderResource(Resource):
     @api.doc('cancel_orders')
     @api.response(404, 'Order not found')
     @api.response(400, 'The Order is not valid for cancel')
-    @api.marshal_with(order_model)
+    @api.response(200, 'Success', order_model)
     def put(self, order_id):
         """ Cancel all the items of the Order that have not being shipped yet """
         app.logger.info("Request to cancel order with id: %s", order_id)
-        order = Order.find(order_id)
-        if not order:
-             api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id))
-
-        shipped_or_delivered_orders = 0
-        try: 
-            for order_item in order.order_items:
-                if order_item.status in ["DELIVERED", "SHIPPED"]:
-                    shipped_or_delivered_orders += 1
-                elif order_item.status != "CANCELLED":
-                    order_item.status = "CANCELLED"
-                if shipped_or_delivered_orders == len(order.order_items):
-                    raise DataValidationError("All the items have been shipped/delivered. Nothing to cancel")
-        except DataValidationError as dataValidationError:
-            api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
-        order.update()
-        return order.serialize(), status.HTTP_200_OK
+        version = check_if_match(order_id)
+        transition_order(order_id, "CANCELLED", version)
+        return order_response(get_order(order_id).serialize())
 
 
 ######################################################################
@@ -363,18 +790,14 @@ class CancelItemResource(Resource):
     @api.doc('cancel_items')
     @api.response(404, 'Order Item not found')
     @api.response(400, 'The Order Item is not valid for cancel')
-    @api.marshal_with(order_model)
+    @api.response(200, 'Success', order_model)
     def put(self, order_id, item_id):
         """ Cancel a single item in the Order that have not being shipped yet """
         app.logger.info("Request to cancel item with id: %s in order with id: %s", item_id, order_id)
+        version = check_if_match(order_id)
         try:
-            order, order_item = get_order_and_order_item(order_id, item_id)
-            if order_item.status in ["DELIVERED", "SHIPPED"]:
-                raise DataValidationError("Item has already been shipped/delivered")
-            if order_item.status != "CANCELLED":
-                order_item.status = "CANCELLED"
-                order.update()
-            return order.serialize(), status.HTTP_200_OK
+            transition_order_item(order_id, item_id, "CANCELLED", version)
+            return order_response(get_order(order_id).serialize())
         except NotFound as notFound:
             api.abort(status.HTTP_404_NOT_FOUND, notFound)
         except DataValidationError as dataValidationError:
@@ -392,27 +815,13 @@ class ShipOrderResource(Resource):
     @api.doc('ship_orders')
     @api.response(404, 'Order not found')
     @api.response(400, 'The Order is not valid for ship')
-    @api.marshal_with(order_model)
+    @api.response(200, 'Success', order_model)
     def put(self, order_id):
         """ ship all the items of the Order that have not being shipped yet """
         app.logger.info("Request to ship order with id: %s", order_id)
-        order = Order.find(order_id)
-        if not order:
-            api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id))
-        shipped_delivered_canceled_orders = 0
-        try:
-            for i in range(len(order.order_items)):
-                if order.order_items[i].status in ["DELIVERED", "CANCELLED"]:
-                    shipped_delivered_canceled_orders += 1
-                elif order.order_items[i].status != "SHIPPED":
-                    order.order_items[i].status = "SHIPPED"
-            if shipped_delivered_canceled_orders == len(order.order_items):
-                raise DataValidationError(
-                    "All the items in this order are DELIVERED/SHIPPED/CANCELED, no items can be shipped.")
-        except DataValidationError as dataValidationError:
-            api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
-        order.update()
-        return order.serialize(), status.HTTP_200_OK
+        version = check_if_match(order_id)
+        transition_order(order_id, "SHIPPED", version)
+        return order_response(get_order(order_id).serialize())
 
 
 ######################################################################
@@ -427,21 +836,17 @@ class ShipItemResource(Resource):
     @api.doc('ship_items')
     @api.response(404, 'Order Item not found')
     @api.response(400, 'The Order Item is not valid for ship')
-    @api.marshal_with(order_model)
+    @api.response(200, 'Success', order_model)
     def put(self, order_id, item_id):
         """
         Change status of a single item in the Order to "SHIPPED".
         The item has not been cancelled or delivered and has been placed
         """
         app.logger.info("Request to ship item with id: %s in order with id: %s", item_id, order_id)
+        version = check_if_match(order_id)
         try:
-            order, order_item = get_order_and_order_item(order_id, item_id)
-            if order_item.status in ["CANCELLED", "DELIVERED"]:
-                raise DataValidationError("Item has already been cancelled/delivered")
-            if order_item.status != "SHIPPED":
-                order_item.status = "SHIPPED"
-                order.update()
-            return order.serialize(), status.HTTP_200_OK
+            transition_order_item(order_id, item_id, "SHIPPED", version)
+            return order_response(get_order(order_id).serialize())
         except NotFound as notFound:
             api.abort(status.HTTP_404_NOT_FOUND, notFound)
         except DataValidationError as dataValidationError:
@@ -460,39 +865,77 @@ class DeliverItemResource(Resource):
     @api.doc('deliver_items')
     @api.response(404, 'Order Item not found')
     @api.response(400, 'The Order Item is not valid for deliver')
-    @api.marshal_with(order_model)
+    @api.response(200, 'Success', order_model)
     def put(self, order_id, item_id):
         """
         Change status of a single item in the Order to "DELIVERED".
         The item has not been cancelled and has been shipped
         """
         app.logger.info("Request to deliver item with id: %s in order with id: %s", item_id, order_id)
+        version = check_if_match(order_id)
         try:
-            order, order_item = get_order_and_order_item(order_id, item_id)
-            if order_item.status == "PLACED":
-                raise DataValidationError("Item has not been shipped yet.")
-            if order_item.status == "CANCELLED":
-                raise DataValidationError("Item has already been cancelled.")
-            if order_item.status == "DELIVERED":
-                raise DataValidationError("Item has already been delivered.")
-            if order_item.status == "SHIPPED":
-                order_item.status = "DELIVERED"
-                order.update()
-            return order.serialize(), status.HTTP_200_OK
+            transition_order_item(order_id, item_id, "DELIVERED", version)
+            return order_response(get_order(order_id).serialize())
         except NotFound as notFound:
             api.abort(status.HTTP_404_NOT_FOUND, notFound)
         except DataValidationError as dataValidationError:
             api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
 
 
-def get_order_and_order_item(order_id, item_id):
+def transition_order(order_id, new_status, version=None):
+    """
+    Moves the items of an Order to a new status, aborting if it can't be moved
+
+    The version matched by If-Match, if any, is checked again by the UPDATE,
+    so a write that lands after check_if_match() still fails the request.
+    """
+    try:
+        outcome = Order.bulk_transition([order_id], new_status, version)
+    except ConcurrencyError:
+        api.abort(status.HTTP_412_PRECONDITION_FAILED,
+                  "Order with id '{}' has been changed by another request.".format(order_id))
+    if order_id not in outcome:
+        api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id))
+    if outcome[order_id]:
+        api.abort(status.HTTP_400_BAD_REQUEST, outcome[order_id])
+
+
+def transition_order_item(order_id, item_id, new_status, version=None):
+    """ Moves an Order Item to a new status, raising why it could not be moved """
+    try:
+        if OrderItem.transition_status(order_id, item_id, new_status, version):
+            return
+    except ConcurrencyError:
+        api.abort(status.HTTP_412_PRECONDITION_FAILED,
+                  "Order with id '{}' has been changed by another request.".format(order_id))
+    order_item = get_order_item(order_id, item_id)
+    error = OrderItem.transition_error(order_item.status, new_status)
+    if error is None and order_item.status == new_status:
+        # the item already was in new_status, nothing had to be written
+        return
+    raise DataValidationError(error or "Item was changed by another request, try again.")
+
+
+def get_order(order_id):
+    """ Returns the Order with the order_id or raises NotFound """
     order = Order.find(order_id)
     if not order:
         raise NotFound("Order with id '{}' was not found.".format(order_id))
-    order_item = find_order_item(order.order_items, item_id)
+    return order
+
+
+def get_order_item(order_id, item_id):
+    """
+    Returns the Order Item with the item_id inside the Order or raises NotFound
+
+    Only used to explain why a status transition was refused, so the
+    happy path never pays for this lookup.
+    """
+    order_item = OrderItem.find(order_id, item_id)
     if not order_item:
+        get_order(order_id)
         raise NotFound("Item with id '{}' was not found inside order.".format(item_id))
-    return order, order_item
+    return order_item
 
 
 ######################################################################
@@ -506,29 +949,13 @@ class DeliverOrderResource(Resource):
     @api.doc('deliver_orders')
     @api.response(404, 'Order not found')
     @api.response(400, 'The Order is not valid for deliver')
-    @api.marshal_with(order_model)
+    @api.response(200, 'Success', order_model)
     def put(self, order_id):
         """ deliver all the items of the Order that have not being delivered yet """
         app.logger.info("Request to deliver order with id: %s", order_id)
-        order = Order.find(order_id)
-        if not order:
-            api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id))
-
-        cancelled_orders = 0
-        try:
-            for i in range(len(order.order_items)):
-                if order.order_items[i].status == "PLACED":
-                    raise DataValidationError("At least one item in this order is PLACED, order cannot be delivered.")
-                elif order.order_items[i].status == "CANCELLED":
-                    cancelled_orders += 1
-                elif order.order_items[i].status != "DELIVERED":
-                    order.order_items[i].status = "DELIVERED"
-            if cancelled_orders == len(order.order_items):
-                raise DataValidationError("All the items in this order are CANCELLED, no items can be delivered.")
-        except DataValidationError as dataValidationError:
-            api.abort(status.HTTP_400_BAD_REQUEST, dataValidationError)
-        order.update()
-        return order.serialize(), status.HTTP_200_OK
+        version = check_if_match(order_id)
+        transition_order(order_id, "DELIVERED", version)
+        return order_response(get_order(order_id).serialize())
 
 
 if __name__ == '__main__':
@@ -539,23 +966,220 @@ def init_db():
     """ Initialies the SQLAlchemy app """
     global app
     Order.init_db(app)
+    slow_log.configure(app.config)
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """ Adds the tables, columns and indexes the database lacks """
+    Order.create_db()
+    app.logger.info("Database upgraded")
 
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
-def check_content_type(content_type):
+def check_content_type(*content_types):
     """ Checks that the media type is correct """
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
         return
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
-    abort(415, "Content-Type must be {}".format(content_type))
+    abort(415, "Content-Type must be {}".format(" or ".join(content_types)))
+
+
+def get_bulk_status_request(data):
+    """
+    Validates the body of a bulk status request
+
+    :return: the target status, the model the ids belong to and the ids
+             without duplicates, in the order they were given
+    """
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid request: body must be an object")
+    new_status = data.get("status")
+    if new_status not in ORDER_TRANSITIONS:
+        raise DataValidationError("Invalid status: must be one of {}".format(
+            ", ".join(sorted(ORDER_TRANSITIONS))))
+    if ("order_ids" in data) == ("item_ids" in data):
+        raise DataValidationError("Invalid request: provide either order_ids or item_ids")
+    if "order_ids" in data:
+        model, ids = Order, data["order_ids"]
+    else:
+        model, ids = OrderItem, data["item_ids"]
+    if not isinstance(ids, list) or not ids or \
+            not all(isinstance(entity_id, int) and not isinstance(entity_id, bool)
+                    for entity_id in ids):
+        raise DataValidationError("Invalid request: ids must be a non empty list of integers")
+    if len(ids) > app.config["BULK_MAX_ORDERS"]:
+        raise DataValidationError(
+            "Too many ids: at most {} per request".format(app.config["BULK_MAX_ORDERS"]))
+    return new_status, model, list(dict.fromkeys(ids))
+
+
+def read_bulk_payload():
+    """
+    Yields the Orders posted to a bulk endpoint one at a time
+
+    NDJSON bodies are read line by line from the request stream; a line
+    that is not valid JSON is yielded as a DataValidationError so it is
+    reported against its own position.
+    """
+    if request.headers["Content-Type"] == "application/x-ndjson":
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield DataValidationError("Invalid order: body of request contained bad or no data")
+        return
+    data = request.get_json()
+    if not isinstance(data, list):
+        raise DataValidationError("Invalid request: body must be a list of orders")
+    yield from data
+
+
+def hash_etag(data):
+    """ Computes a strong ETag from the JSON form of data """
+    raw = json.dumps(data, sort_keys=True, separators=(",", ":"), default=datetime.isoformat)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def order_etag(order, fields=None):
+    """ Computes the ETag of a serialized Order from its id, version and returned fields """
+    etag = "{}-{}".format(order["id"], order["version"])
+    if fields is not None:
+        etag += "+" + "+".join(sorted(fields))
+    return etag
+
+
+def order_response(order, code=status.HTTP_200_OK):
+    """ Returns a serialized Order as JSON with its ETag """
+    return json_response(order, code, {"ETag": quote_etag(order_etag(order))})
+
+
+def not_modified(etag):
+    """ Returns an empty 304 Not Modified response carrying the ETag """
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
 
+def check_if_match(order_id):
+    """
+    Checks the If-Match precondition of a request that changes an Order
+
+    The current version is read from the database, not the cache, and
+    the request is aborted with 412 Precondition Failed when the client's
+    copy of the Order is no longer the current one.
+
+    :return: the version the client's copy matched, or None without If-Match
+    """
+    if not request.if_match:
+        return None
+    version = Order.find_version(order_id)
+    if version is None:
+        api.abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id))
+    # the ETags of compressed responses are weak, they still name the version
+    if not request.if_match.contains_weak(order_etag({"id": order_id, "version": version})):
+        api.abort(status.HTTP_412_PRECONDITION_FAILED,
+                  "Order with id '{}' has been changed by another request.".format(order_id))
+    return version
+
+
+def check_version(order, *versions):
+    """ Raises ConcurrencyError if the Order is not at every version the client expects """
+    for version in versions:
+        if version is not None and version != order.version:
+            raise ConcurrencyError(
+                "Order with id '{}' has been changed by another request.".format(order.id))
 
-def find_order_item(order_items, item_id):
-    """ Find order item with the item_id """
-    for order_item in order_items:
-        if order_item.item_id == item_id:
-            return order_item
-    return None
+
+def wants_ndjson():
+    """ Checks if the client prefers newline delimited JSON """
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+
+def stream_orders(orders, ndjson=False, fields=None):
+    """
+    Streams Orders to the client as they are read from the database
+
+    Each Order is written as one line of NDJSON, or as one element of a
+    chunked JSON array, so only the current batch is held in memory.
+    """
+    def generate():
+        count = 0
+        if not ndjson:
+            yield b"["
+        for order in orders:
+            body = dumps(order.serialize(fields))
+            if ndjson:
+                yield body + b"\n"
+            else:
+                yield body if count == 0 else b"," + body
+            count += 1
+        if not ndjson:
+            yield b"]"
+        app.logger.info("Streamed %d orders", count)
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(stream_with_context(generate()), status=status.HTTP_200_OK, mimetype=mimetype)
+
+
+def get_fields(args):
+    """
+    Returns the fields of the Orders asked for by fields= and include_items=
+
+    None stands for the whole representation of the Orders.
+    """
+    fields = None
+    if args["fields"]:
+        fields = {name.strip() for name in args["fields"].split(",") if name.strip()}
+        unknown = fields.difference(ORDER_FIELDS)
+        if unknown:
+            raise DataValidationError("Invalid fields: {}".format(", ".join(sorted(unknown))))
+    if args["include_items"] is not None:
+        if fields is None:
+            fields = set(ORDER_FIELDS)
+        if args["include_items"]:
+            fields.add("order_items")
+        else:
+            fields.discard("order_items")
+    if fields == set(ORDER_FIELDS):
+        return None
+    return fields
+
+
+def get_page_limit(limit):
+    """ Returns the page size to use, capped by the server maximum """
+    if limit is None:
+        return app.config["PAGE_SIZE_DEFAULT"]
+    if limit < 1:
+        raise DataValidationError("Invalid limit: must be a positive integer")
+    return min(limit, app.config["PAGE_SIZE_MAX"])
+
+
+def encode_cursor(sort_key):
+    """ Encodes the sort key of the last Order of a page into an opaque cursor """
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in sort_key]
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort="id"):
+    """ Decodes a cursor created by encode_cursor back into the sort key of an Order """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if sort.lstrip("-") == "created_date" and isinstance(values, list) and len(values) == 2:
+            values[0] = datetime.fromisoformat(values[0])
+    except (TypeError, ValueError):
+        raise DataValidationError("Invalid cursor: {}".format(cursor))
+    expected = 1 if sort.lstrip("-") == "id" else 2
+    if (not isinstance(values, list) or len(values) != expected
+            or not all(isinstance(value, (int, float, datetime)) for value in values)
+            or not isinstance(values[-1], int)):
+        raise DataValidationError("Invalid cursor: {}".format(cursor))
+    return values
@@ -0,0 +1,159 @@
+"""
+Module to log the slow requests with the SQL statements they sent
+
+A request is logged when it takes longer than SLOW_REQUEST_MS, or when
+one of its statements takes longer than SLOW_QUERY_MS. The entry holds the
+route and the parameters of the request and every statement it sent, with
+its duration and row count. Only a SLOW_LOG_SAMPLE_RATE fraction of the
+requests have their statements captured, and at most
+SLOW_LOG_MAX_PER_MINUTE entries are written per worker, so a slow database
+can't flood the logs.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from flask import g, request
+from .statements import statement_timer
+
+logger = logging.getLogger("flask.app")
+
+
+class RateLimiter:
+    """ A token bucket allowing up to rate events per period seconds """
+
+    def __init__(self, rate, period=60.0, clock=time.monotonic):
+        self.rate = rate
+        self.period = period
+        self.clock = clock
+        self.tokens = rate
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Returns True if one more event may happen now """
+        with self._lock:
+            now = self.clock()
+            refill = (now - self.updated) * self.rate / self.period
+            self.tokens = min(self.rate, self.tokens + refill)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CapturedRequest:
+    """ The statements of a request whose statements are captured """
+
+    def __init__(self, started):
+        self.started = started
+        self.status = None
+        self.statements = []
+
+
+class SlowLog:
+    """
+    Logs the requests and statements that ran longer than their threshold
+
+    Thresholds are in seconds. The statements are timed by the
+    StatementTimer shared with the request metrics, and the entry is
+    written when the request is torn down, so a streamed response is
+    logged once it has been sent in full.
+    """
+
+    def __init__(self, request_threshold=0.5, query_threshold=0.1, sample_rate=1.0,
+                 max_per_minute=10, clock=time.perf_counter, sample=random.random,
+                 timer=statement_timer):
+        # pylint: disable=too-many-arguments
+        self.request_threshold = request_threshold
+        self.query_threshold = query_threshold
+        self.sample_rate = sample_rate
+        self.limiter = RateLimiter(max_per_minute)
+        self.clock = clock
+        self.sample = sample
+        self.timer = timer
+        self.logged = 0
+        self.suppressed = 0
+        self._suppressed_since_logged = 0
+        self._key = "slow_log_{}".format(id(self))
+        self._listening = False
+
+    def configure(self, config):
+        """
+        Reads the thresholds, the sample rate and the rate limit from the SLOW_* settings
+
+        :param config: the configuration of the Flask app
+
+        """
+        self.request_threshold = config["SLOW_REQUEST_MS"] / 1000
+        self.query_threshold = config["SLOW_QUERY_MS"] / 1000
+        self.sample_rate = config["SLOW_LOG_SAMPLE_RATE"]
+        self.limiter = RateLimiter(config["SLOW_LOG_MAX_PER_MINUTE"])
+
+    def init_app(self, app):
+        """ Watches the requests to app and the SQL statements they send """
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        app.teardown_request(self.teardown_request)
+        if not self._listening:
+            self.timer.add_listener(self._record_statement)
+            self._listening = True
+
+    def start_request(self):
+        """ Starts capturing the statements of a sample of the requests """
+        if self.sample_rate > 0 and self.sample() < self.sample_rate:
+            setattr(g, self._key, CapturedRequest(self.clock()))
+
+    def end_request(self, response):
+        """ Notes the status of the response """
+        captured = g.get(self._key)
+        if captured is not None:
+            captured.status = response.status_code
+        return response
+
+    def teardown_request(self, exc):  # pylint: disable=unused-argument
+        """ Logs the request if it or one of its statements was slow """
+        captured = g.pop(self._key, None)
+        if captured is None:
+            return
+        duration = self.clock() - captured.started
+        if (duration < self.request_threshold
+                and all(statement["duration_ms"] < self.query_threshold * 1000
+                        for statement in captured.statements)):
+            return
+        if not self.limiter.allow():
+            self.suppressed += 1
+            self._suppressed_since_logged += 1
+            return
+        self.logged += 1
+        entry = {
+            "method": request.method,
+            "route": request.url_rule.rule if request.url_rule else None,
+            "path": request.path,
+            "view_args": request.view_args,
+            "args": request.args.to_dict(flat=False),
+            "status": captured.status,
+            "duration_ms": round(duration * 1000, 3),
+            "statements": captured.statements,
+            # the slow requests left out since the previous entry
+            "suppressed": self._suppressed_since_logged,
+        }
+        self._suppressed_since_logged = 0
+        logger.warning("Slow request %s %s took %.1f ms: %s", request.method, request.path,
+                       duration * 1000, json.dumps(entry, default=str))
+
+    def _record_statement(self, statement, duration, cursor):
+        captured = g.get(self._key)
+        if captured is None:
+            return
+        captured.statements.append({
+            "statement": statement,
+            "duration_ms": round(duration * 1000, 3),
+            "rows": cursor.rowcount,
+        })
+
+    def stats(self):
+        """ Returns the number of entries logged and of those suppressed by the rate limit """
+        return {"logged": self.logged, "suppressed": self.suppressed}
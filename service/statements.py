@@ -0,0 +1,54 @@
+"""
+Module to time the SQL statements sent while serving a request
+
+The cursor events of every SQLAlchemy engine are listened to once, and the
+duration of each statement sent inside a request is handed to every
+listener, such as the request metrics and the slow request log, so a
+statement is timed once however many of them watch it. The reads sent to
+the read replicas are timed too.
+"""
+import threading
+import time
+from flask import has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class StatementTimer:
+    """
+    Times the SQL statements of every engine for the listeners added to it
+
+    A listener is called after each statement sent inside a request with
+    the statement, its duration in seconds and its cursor.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.listeners = []
+        self._local = threading.local()
+        self._listening = False
+
+    def add_listener(self, listener):
+        """ Calls listener(statement, duration, cursor) after every statement of a request """
+        self.listeners.append(listener)
+        if not self._listening:
+            event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+            self._listening = True
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # pylint: disable=unused-argument,too-many-arguments
+        self._local.started = self.clock()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # pylint: disable=unused-argument,too-many-arguments
+        started = getattr(self._local, "started", None)
+        if started is None or not has_request_context():
+            return
+        duration = self.clock() - started
+        for listener in self.listeners:
+            listener(statement, duration, cursor)
+
+
+# Times the statements of the service for its metrics and its slow request log
+statement_timer = StatementTimer()
@@ -0,0 +1,26 @@
+"""
+A fake clock for the tests of the code that reads the time
+"""
+
+
+class FakeClock:
+    """
+    A clock that only moves when told to
+
+    It moves forward by step seconds each time it is read, and by the time
+    slept when sleep() is called in its place. Tests may also set now.
+    """
+
+    def __init__(self, step=0.0):
+        self.now = 0.0
+        self.step = step
+        self.slept = []
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+    def sleep(self, seconds):
+        """ Moves forward by seconds instead of sleeping """
+        self.slept.append(seconds)
+        self.now += seconds
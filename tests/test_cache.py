@@ -0,0 +1,127 @@
+""" Module for order cache tests """
+import unittest
+from datetime import datetime
+from service.cache import LRUCache, NullCache, SharedCache, create_cache
+from .fake_clock import FakeClock
+
+
+class FakeRedis:
+    """ Local stand-in for the commands of a Redis client used by SharedCache """
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value.encode("utf-8")
+        self.ttls[key] = ttl
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        prefix = pattern.rstrip("*")
+        return [key for key in list(self.data) if key.startswith(prefix)]
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the in-process LRU cache """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(max_entries=2, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """ Read back a cached value and count hits and misses """
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {"id": 1})
+        self.assertEqual(self.cache.get(1), {"id": 1})
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_expiry(self):
+        """ Entries older than the ttl are missing """
+        self.cache.set(1, {"id": 1})
+        self.clock.now = 9.9
+        self.assertIsNotNone(self.cache.get(1))
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_eviction(self):
+        """ The least recently used entry is evicted when the cache is full """
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.get(1)
+        self.cache.set(3, "three")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "one")
+        self.assertEqual(self.cache.get(3), "three")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_delete_and_clear(self):
+        """ Remove one entry, then every entry """
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.delete(1)
+        self.cache.delete(5)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+
+
+class TestSharedCache(unittest.TestCase):
+    """ Test Cases for the shared cache """
+
+    def setUp(self):
+        self.client = FakeRedis()
+        self.cache = SharedCache(self.client, ttl=15)
+
+    def test_get_and_set(self):
+        """ Values round trip through the store as JSON """
+        created_date = datetime(2020, 11, 1, 12, 30)
+        self.cache.set(1, {"id": 1, "created_date": created_date})
+        self.assertEqual(self.client.ttls["orders:1"], 15)
+        self.assertEqual(self.cache.get(1), {"id": 1, "created_date": "2020-11-01T12:30:00"})
+        self.assertIsNone(self.cache.get(2))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_delete_and_clear(self):
+        """ Remove one entry, then every entry of the cache """
+        self.client.setex("other:1", 10, "kept")
+        self.cache.set(1, {"id": 1})
+        self.cache.set(2, {"id": 2})
+        self.cache.delete(1)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+        self.assertIn("other:1", self.client.data)
+
+
+class TestCreateCache(unittest.TestCase):
+    """ Test Cases for picking the cache backend """
+
+    def test_create_cache(self):
+        """ Create the backend named in the configuration """
+        config = {"CACHE_MAX_ENTRIES": 5, "CACHE_TTL": 1}
+        self.assertIsInstance(create_cache(dict(config, CACHE_BACKEND="memory")), LRUCache)
+        self.assertIsInstance(create_cache(dict(config, CACHE_BACKEND="none")), NullCache)
+        cache = NullCache()
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
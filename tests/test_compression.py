@@ -0,0 +1,91 @@
+""" Module for response compression tests """
+import gzip
+import unittest
+from unittest.mock import patch
+from flask import Response
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+from service import compression
+from service.compression import choose_encoding, compress_response, compress_stream
+
+BODY = b'{"id":1,"customer_id":7,"order_items":[]}' * 100
+
+
+def accept(header):
+    """ Parses an Accept-Encoding header """
+    return parse_accept_header(header, Accept)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCompression(unittest.TestCase):
+    """ Test Cases for the compression of responses """
+
+    def test_choose_encoding(self):
+        """ Pick the content coding the client accepts """
+        with patch.object(compression, "brotli", None):
+            self.assertEqual(choose_encoding(accept("gzip, deflate")), "gzip")
+            self.assertEqual(choose_encoding(accept("*")), "gzip")
+            self.assertIsNone(choose_encoding(accept("br, identity")))
+            self.assertIsNone(choose_encoding(accept("gzip;q=0")))
+            self.assertIsNone(choose_encoding(accept("")))
+
+    def test_choose_encoding_prefers_brotli(self):
+        """ Pick brotli over gzip when it is installed, unless the client prefers gzip """
+        with patch.object(compression, "brotli", object()):
+            self.assertEqual(choose_encoding(accept("gzip, br")), "br")
+            self.assertEqual(choose_encoding(accept("gzip, br;q=0.5")), "gzip")
+
+    def test_compress_stream(self):
+        """ Compress a body written in chunks """
+        chunks = [b"[", BODY, b",", BODY, b"]"]
+        data = b"".join(compress_stream(iter(chunks), "gzip", 6))
+        self.assertEqual(gzip.decompress(data), b"".join(chunks))
+
+    def test_compress_response(self):
+        """ Compress a large JSON response and weaken its ETag """
+        resp = Response(BODY, mimetype="application/json", headers={"ETag": '"1-2"'})
+        compress_response(resp, accept("gzip"), 1024, 6)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(resp.headers["ETag"], 'W/"1-2"')
+        self.assertEqual(int(resp.headers["Content-Length"]), len(resp.get_data()))
+        self.assertEqual(gzip.decompress(resp.get_data()), BODY)
+
+    def test_compress_response_skipped(self):
+        """ Leave small, non JSON, empty and unacceptable responses alone """
+        for resp, accept_encodings, level in [
+                (Response(b"{}", mimetype="application/json"), accept("gzip"), 6),
+                (Response(BODY, mimetype="text/html"), accept("gzip"), 6),
+                (Response(status=304, mimetype="application/json"), accept("gzip"), 6),
+                (Response(BODY, mimetype="application/json"), accept("identity"), 6),
+                (Response(BODY, mimetype="application/json"), accept("gzip"), 0)]:
+            compress_response(resp, accept_encodings, 1024, level)
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_compress_streamed_response(self):
+        """ Compress a streamed response whatever its size """
+        closed = []
+
+        def generate():
+            try:
+                yield b"["
+                yield b"]"
+            finally:
+                closed.append(True)
+
+        resp = Response(generate(), mimetype="application/x-ndjson")
+        compress_response(resp, accept("gzip"), 1024, 6)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", resp.headers)
+        self.assertEqual(gzip.decompress(b"".join(resp.response)), b"[]")
+        self.assertEqual(closed, [True])
+
+    @unittest.skipIf(compression.brotli is None, "brotli is not installed")
+    def test_compress_response_brotli(self):
+        """ Compress a large JSON response with brotli """
+        resp = Response(BODY, mimetype="application/json")
+        compress_response(resp, accept("br, gzip"), 1024, 6)
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(compression.brotli.decompress(resp.get_data()), BODY)
@@ -0,0 +1,27 @@
+""" Module for the tests of the load test """
+import unittest
+from benchmarks.load import percentile
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPercentile(unittest.TestCase):
+    """ Test Cases for the latency percentiles of the load test """
+
+    def test_nearest_rank(self):
+        """ Return the sample at the nearest rank """
+        latencies = list(range(1, 101))
+        self.assertEqual(percentile(latencies, 0.50), 50)
+        self.assertEqual(percentile(latencies, 0.95), 95)
+        self.assertEqual(percentile(latencies, 0.99), 99)
+        latencies = list(range(1, 21))
+        self.assertEqual(percentile(latencies, 0.95), 19)
+        self.assertEqual(percentile(latencies, 0.99), 20)
+        self.assertEqual(percentile([1, 2, 3], 0.50), 2)
+
+    def test_few_samples(self):
+        """ Return the only sample, or None without samples """
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertEqual(percentile([7], 0.0), 7)
+        self.assertIsNone(percentile([], 0.5))
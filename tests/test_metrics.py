@@ -0,0 +1,79 @@
+""" Module for request metrics tests """
+import os
+import unittest
+from unittest.mock import patch
+from flask import Flask
+from prometheus_client import CollectorRegistry
+from sqlalchemy import create_engine
+from service.metrics import RequestMetrics
+from service.statements import StatementTimer
+from .fake_clock import FakeClock
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRequestMetrics(unittest.TestCase):
+    """ Test Cases for the request metrics """
+
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        clock = FakeClock(step=1)
+        self.metrics = RequestMetrics(self.registry, clock=clock, timer=StatementTimer(clock))
+        self.engine = create_engine("sqlite://")
+        self.app = Flask(__name__)
+        self.metrics.init_app(self.app)
+
+        @self.app.route("/orders/<int:order_id>")
+        def get_order(order_id):  # pylint: disable=unused-variable
+            with self.engine.connect() as conn:
+                conn.execute("SELECT 1")
+                conn.execute("SELECT 2")
+            return str(order_id), 404
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def _sample(self, name, **labels):
+        return self.registry.get_sample_value(name, labels)
+
+    def test_request_measured(self):
+        """ Record the latency, status and SQL statements of a request """
+        client = self.app.test_client()
+        client.get("/orders/1")
+        client.get("/orders/2")
+        labels = {"method": "GET", "route": "/orders/<int:order_id>"}
+        self.assertEqual(self._sample("http_requests_total", status="404", **labels), 2)
+        self.assertEqual(self._sample("http_request_duration_seconds_count", **labels), 2)
+        # each request reads the clock once per statement on each side, and
+        # once when it starts and ends
+        self.assertEqual(self._sample("http_request_duration_seconds_sum", **labels), 2 * 5)
+        self.assertEqual(self._sample("http_request_sql_statements_sum", **labels), 4)
+        self.assertEqual(self._sample("http_request_database_duration_seconds_sum", **labels), 4)
+
+    def test_unmatched_route(self):
+        """ Label the requests to unknown URLs with a single route """
+        self.app.test_client().get("/nowhere")
+        self.assertEqual(self._sample("http_requests_total", method="GET", route="<unmatched>",
+                                      status="404"), 1)
+
+    def test_statements_outside_requests_ignored(self):
+        """ Don't count the statements sent outside of a request """
+        with self.engine.connect() as conn:
+            conn.execute("SELECT 1")
+        self.app.test_client().get("/orders/1")
+        self.assertEqual(self._sample("http_request_sql_statements_sum", method="GET",
+                                      route="/orders/<int:order_id>"), 2)
+
+    def test_export(self):
+        """ Export the measures in the Prometheus text format """
+        self.app.test_client().get("/orders/1")
+        body, content_type = self.metrics.export()
+        self.assertTrue(content_type.startswith("text/plain"))
+        self.assertIn(b'http_requests_total{method="GET",route="/orders/<int:order_id>",status="404"}',
+                      body)
+
+    def test_export_multiprocess(self):
+        """ Export the measures written by every worker process """
+        with patch.dict(os.environ, {"prometheus_multiproc_dir": "/nonexistent"}):
+            self.assertRaises(ValueError, self.metrics.export)
@@ -0,0 +1,70 @@
+""" Module for database connection pool tests """
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool
+from service.pool import PooledSQLAlchemy, TimedQueuePool, pool_options, pool_stats
+
+CONFIG = {
+    "DB_POOL_SIZE": 1,
+    "DB_MAX_OVERFLOW": 1,
+    "DB_POOL_TIMEOUT": 0,
+    "DB_POOL_RECYCLE": 60,
+    "DB_POOL_PRE_PING": True,
+}
+
+
+class FakeApp:
+    """ The parts of a Flask app used when configuring the engine """
+
+    root_path = "/tmp"
+    config = dict(CONFIG, SQLALCHEMY_NATIVE_UNICODE=None)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPool(unittest.TestCase):
+    """ Test Cases for the database connection pool """
+
+    def test_pool_stats(self):
+        """ Count the connections in use, the overflow and the timeouts """
+        engine = create_engine("sqlite://", **pool_options(CONFIG))
+        self.assertIsInstance(engine.pool, TimedQueuePool)
+        first = engine.connect()
+        second = engine.connect()
+        stats = pool_stats(engine)
+        self.assertEqual(stats["pool"], "TimedQueuePool")
+        self.assertEqual(stats["checked_out"], 2)
+        self.assertEqual(stats["overflow"], 1)
+        self.assertEqual(stats["max_overflow"], 1)
+        self.assertRaises(PoolTimeoutError, engine.connect)
+        second.close()
+        first.close()
+        stats = pool_stats(engine)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["checkouts"], 3)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreaterEqual(stats["wait_time_max"], 0.0)
+        self.assertGreaterEqual(stats["wait_time"], stats["wait_time_max"])
+
+    def test_pool_stats_other_pool(self):
+        """ Report the status of a pool that isn't timed """
+        engine = create_engine("sqlite://", poolclass=NullPool)
+        stats = pool_stats(engine)
+        self.assertEqual(stats["pool"], "NullPool")
+        self.assertIn("status", stats)
+
+    def test_pool_options_applied(self):
+        """ Apply the pool settings to every database but SQLite """
+        db = PooledSQLAlchemy()
+        options = {}
+        db.apply_driver_hacks(FakeApp, make_url("postgres://localhost/orders"), options)
+        self.assertEqual(options["poolclass"], TimedQueuePool)
+        self.assertEqual(options["pool_size"], 1)
+        self.assertEqual(options["pool_recycle"], 60)
+        self.assertTrue(options["pool_pre_ping"])
+        options = {}
+        db.apply_driver_hacks(FakeApp, make_url("sqlite:///orders.db"), options)
+        self.assertNotIn("pool_size", options)
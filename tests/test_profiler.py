@@ -0,0 +1,71 @@
+""" Module for request profiling tests """
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from flask import Flask, Response, stream_with_context
+from service.profiler import ProfilerMiddleware
+
+
+def render_order(order_id):
+    """ The function the profiles are expected to contain """
+    return "order {}".format(order_id)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestProfilerMiddleware(unittest.TestCase):
+    """ Test Cases for the on demand profiling of requests """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(PROFILE_SECRET="s3cret", PROFILE_DIR=self.directory)
+        self.app.wsgi_app = ProfilerMiddleware(self.app.wsgi_app, self.app.config)
+
+        @self.app.route("/orders/<int:order_id>")
+        def get_order(order_id):  # pylint: disable=unused-variable
+            return render_order(order_id)
+
+        @self.app.route("/orders")
+        def list_orders():  # pylint: disable=unused-variable
+            def generate():
+                for order_id in range(3):
+                    yield render_order(order_id)
+            return Response(stream_with_context(generate()))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _functions(self, name):
+        """ Returns the names of the functions in a stored profile """
+        stats = pstats.Stats(os.path.join(self.directory, name))
+        return {function for _, _, function in stats.stats}
+
+    def test_profile_request(self):
+        """ Profile a request sent with the secret """
+        resp = self.app.test_client().get("/orders/7", headers={"X-Profile": "s3cret"})
+        self.assertEqual(resp.data, b"order 7")
+        name = resp.headers["X-Profile-Dump"]
+        self.assertRegex(name, r"^\d+-\d+-GET-orders-7\.prof$")
+        self.assertEqual(os.listdir(self.directory), [name])
+        self.assertIn("render_order", self._functions(name))
+
+    def test_profile_streamed_request(self):
+        """ Profile a streamed response to its end """
+        resp = self.app.test_client().get("/orders", headers={"X-Profile": "s3cret"})
+        self.assertEqual(resp.data, b"order 0order 1order 2")
+        self.assertIn("render_order", self._functions(resp.headers["X-Profile-Dump"]))
+
+    def test_not_profiled(self):
+        """ Don't profile requests without the secret, or when profiling is off """
+        client = self.app.test_client()
+        for headers in [{}, {"X-Profile": "wrong"}]:
+            resp = client.get("/orders/7", headers=headers)
+            self.assertNotIn("X-Profile-Dump", resp.headers)
+        self.app.config["PROFILE_SECRET"] = ""
+        resp = client.get("/orders/7", headers={"X-Profile": ""})
+        self.assertNotIn("X-Profile-Dump", resp.headers)
+        self.assertEqual(os.listdir(self.directory), [])
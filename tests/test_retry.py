@@ -0,0 +1,130 @@
+""" Module for database retry policy tests """
+import unittest
+from sqlalchemy.exc import IntegrityError, OperationalError
+from service.retry import RetryPolicy, is_transient
+from .fake_clock import FakeClock
+
+
+class FakeDBAPIError(Exception):
+    """ A driver error carrying a PostgreSQL SQLSTATE """
+
+    def __init__(self, pgcode=None, message=None):
+        super().__init__(message or pgcode)
+        self.pgcode = pgcode
+
+
+def operational_error(pgcode=None, message="database is locked"):
+    """ Returns an OperationalError as raised by SQLAlchemy """
+    return OperationalError("SELECT 1", {}, FakeDBAPIError(pgcode, message))
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRetryPolicy(unittest.TestCase):
+    """ Test Cases for the database retry policy """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.rollbacks = 0
+        self.policy = RetryPolicy(rollback=self._rollback, attempts=4, base_delay=0.01,
+                                  max_delay=0.05, deadline=1.0,
+                                  sleep=self.clock.sleep, clock=self.clock)
+
+    def _rollback(self):
+        self.rollbacks += 1
+
+    def _failing(self, *errors, result="done"):
+        """ Returns a decorated function that raises errors in turn, then returns result """
+        errors = list(errors)
+
+        @self.policy
+        def work():
+            if errors:
+                raise errors.pop(0)
+            return result
+        return work
+
+    def test_transient_errors(self):
+        """ Tell the transient database errors from the others """
+        self.assertTrue(is_transient(operational_error()))
+        self.assertTrue(is_transient(operational_error("40001")))
+        self.assertTrue(is_transient(operational_error("40P01")))
+        self.assertTrue(is_transient(operational_error("08006")))
+        self.assertTrue(is_transient(operational_error("57P01")))
+        self.assertFalse(is_transient(operational_error("53100")))
+        self.assertFalse(is_transient(IntegrityError("INSERT", {}, FakeDBAPIError("23505"))))
+        self.assertFalse(is_transient(ValueError()))
+
+    def test_permanent_errors_without_sqlstate(self):
+        """ It does not retry the errors of drivers without SQLSTATE unless they are locks """
+        self.assertTrue(is_transient(operational_error(message="Database is locked")))
+        self.assertTrue(is_transient(operational_error(message="database table is locked: orders")))
+        self.assertFalse(is_transient(operational_error(message="no such table: orders")))
+        self.assertFalse(is_transient(operational_error(message='near "SELEC": syntax error')))
+        invalidated = operational_error(message="server closed the connection unexpectedly")
+        invalidated.connection_invalidated = True
+        self.assertTrue(is_transient(invalidated))
+
+    def test_retry_recovers(self):
+        """ Retry a transient failure after rolling back the session """
+        work = self._failing(operational_error("40001"), operational_error("40P01"))
+        self.assertEqual(work(), "done")
+        self.assertEqual(self.rollbacks, 2)
+        self.assertEqual(len(self.clock.slept), 2)
+        self.assertLessEqual(self.clock.slept[0], 0.01)
+        self.assertLessEqual(self.clock.slept[1], 0.02)
+        stats = self.policy.stats()
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["recovered"], 1)
+        self.assertEqual(stats["exhausted"], 0)
+        self.assertEqual(list(stats["retries_by_operation"].values()), [2])
+
+    def test_retry_attempts_exhausted(self):
+        """ Give up after the last attempt """
+        work = self._failing(*[operational_error() for _ in range(5)])
+        self.assertRaises(OperationalError, work)
+        self.assertEqual(self.rollbacks, 3)
+        self.assertEqual(self.policy.stats()["exhausted"], 1)
+
+    def test_retry_deadline(self):
+        """ Don't start an attempt that would end after the deadline """
+        self.policy.deadline = 0.0
+        work = self._failing(operational_error())
+        self.assertRaises(OperationalError, work)
+        self.assertEqual(self.rollbacks, 0)
+        self.assertEqual(self.clock.slept, [])
+
+    def test_no_retry_on_permanent_error(self):
+        """ Raise errors that would fail again at once """
+        work = self._failing(IntegrityError("INSERT", {}, FakeDBAPIError("23505")))
+        self.assertRaises(IntegrityError, work)
+        work = self._failing(ValueError("bad"))
+        self.assertRaises(ValueError, work)
+        self.assertEqual(self.policy.stats()["retries"], 0)
+
+    def test_nested_calls_retried_once(self):
+        """ Only the outermost decorated call retries """
+        inner = self._failing(operational_error())
+
+        @self.policy
+        def outer():
+            return inner()
+        self.assertEqual(outer(), "done")
+        self.assertEqual(self.policy.stats()["retries_by_operation"],
+                         {outer.__qualname__: 1})
+
+    def test_backoff_capped(self):
+        """ The delay doubles with each attempt up to the cap """
+        for attempt in range(1, 10):
+            self.assertLessEqual(self.policy.delay(attempt),
+                                 min(0.05, 0.01 * 2 ** (attempt - 1)))
+
+    def test_configure(self):
+        """ Read the policy from the app config """
+        self.policy.configure({"DB_RETRY_ATTEMPTS": 2, "DB_RETRY_BASE_DELAY_MS": 5,
+                               "DB_RETRY_MAX_DELAY_MS": 100, "DB_RETRY_DEADLINE_MS": 250})
+        self.assertEqual(self.policy.attempts, 2)
+        self.assertEqual(self.policy.base_delay, 0.005)
+        self.assertEqual(self.policy.max_delay, 0.1)
+        self.assertEqual(self.policy.deadline, 0.25)
@@ -0,0 +1,73 @@
+""" Module for read replica routing tests """
+import unittest
+from sqlalchemy import create_engine
+from service.routing import ReplicaSet
+from .fake_clock import FakeClock
+
+
+class CheckedReplicaSet(ReplicaSet):
+    """ A ReplicaSet whose health checks answer from a set of failing engines """
+
+    def __init__(self, engines, down, **kwargs):
+        self.down = down
+        self.checks = 0
+        super().__init__(engines, **kwargs)
+
+    def check(self, engine):
+        self.checks += 1
+        return engine not in self.down
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestReplicaSet(unittest.TestCase):
+    """ Test Cases for the read replicas """
+
+    def setUp(self):
+        self.engines = [create_engine("sqlite://") for _ in range(3)]
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    def test_round_robin(self):
+        """ Hand out the replicas in turn """
+        replicas = CheckedReplicaSet(self.engines, set(), clock=self.clock)
+        chosen = [replicas.choose() for _ in range(6)]
+        self.assertEqual(chosen, self.engines * 2)
+        self.assertEqual([stats["reads"] for stats in replicas.stats()], [2, 2, 2])
+
+    def test_unhealthy_replica_skipped(self):
+        """ Skip a replica that failed its health check until it passes again """
+        down = {self.engines[1]}
+        replicas = CheckedReplicaSet(self.engines, down, check_interval=5, clock=self.clock)
+        chosen = [replicas.choose() for _ in range(4)]
+        self.assertNotIn(self.engines[1], chosen)
+        self.assertFalse(replicas.is_healthy(self.engines[1]))
+        down.clear()
+        replicas.choose()
+        self.assertFalse(replicas.is_healthy(self.engines[1]))
+        self.clock.now = 5
+        chosen = [replicas.choose() for _ in range(3)]
+        self.assertIn(self.engines[1], chosen)
+
+    def test_health_checked_once_per_interval(self):
+        """ Check each replica at most once per interval """
+        replicas = CheckedReplicaSet(self.engines, set(), check_interval=5, clock=self.clock)
+        for _ in range(9):
+            replicas.choose()
+        self.assertEqual(replicas.checks, 3)
+
+    def test_no_healthy_replica(self):
+        """ Return None when every replica is down """
+        replicas = CheckedReplicaSet(self.engines, set(self.engines), clock=self.clock)
+        self.assertIsNone(replicas.choose())
+        self.assertIsNone(ReplicaSet().choose())
+        self.assertFalse(ReplicaSet())
+
+    def test_check(self):
+        """ Check a replica with a query """
+        self.assertTrue(ReplicaSet.check(self.engines[0]))
+        self.assertFalse(ReplicaSet.check(create_engine("sqlite:////nonexistent/orders.db")))
@@ -0,0 +1,45 @@
+""" Module for JSON serialization tests """
+import json
+import unittest
+from unittest.mock import patch
+from service import serialization
+from service.serialization import dumps, json_response
+
+ORDER = {
+    "id": 1,
+    "customer_id": 7,
+    "created_date": "2020-11-01T12:30:00.123456",
+    "version": 2,
+    "total_amount": 12.5,
+    "item_count": 1,
+    "order_status": "PLACED",
+    "order_items": [{"item_id": 3, "product_id": 4, "quantity": 5, "price": 2.5,
+                     "status": "PLACED"}],
+}
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSerialization(unittest.TestCase):
+    """ Test Cases for the JSON encoding of responses """
+
+    def test_dumps(self):
+        """ Encode a serialized Order with the encoder that is installed """
+        self.assertEqual(json.loads(dumps(ORDER)), ORDER)
+        self.assertIsInstance(dumps([ORDER]), bytes)
+
+    def test_dumps_without_orjson(self):
+        """ Encode a serialized Order with the standard library """
+        with patch.object(serialization, "orjson", None):
+            raw = dumps(ORDER)
+        self.assertEqual(json.loads(raw), ORDER)
+        self.assertNotIn(b" ", raw.replace(b"PLACED", b""))
+
+    def test_json_response(self):
+        """ Build a JSON response with headers """
+        resp = json_response([ORDER], 201, {"ETag": '"1-2"'})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual(resp.headers["ETag"], '"1-2"')
+        self.assertEqual(json.loads(resp.get_data()), [ORDER])
@@ -7,13 +7,23 @@ Test cases can be run with the following:
 from unittest import TestCase
 from unittest.mock import patch
 import os
+import gzip
+import pstats
+import shutil
+import tempfile
+import json
 import logging
+from contextlib import contextmanager
 from flask_api import status
+from sqlalchemy import event
 from flask import abort
-from service.models import DataValidationError, db
+from flask_restx import marshal
+from service.cache import SharedCache
+from service.models import DataValidationError, Order, db
 from service import app
-from service.service import init_db
+from service.service import init_db, order_model
 from .order_factory import OrderFactory, OrderItemFactory
+from .test_cache import FakeRedis
 
 logging.disable(logging.CRITICAL)
 
@@ -78,6 +88,33 @@ class TestOrderService(TestCase):
             orders.append(test_order)
         return orders
 
+    @contextmanager
+    def _count_queries(self):
+        """ Counts the SQL statements sent to the database """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    @contextmanager
+    def _in_production(self):
+        """ Lets the errors of the resources go through their handlers, as they do in production """
+        with patch.dict(app.config, {"TESTING": False}):
+            yield
+
+    def _create_order_with_items(self, count):
+        """ Creates an Order with count items through the API """
+        resp = self.app.post("/orders", json=_get_order_factory_with_items(count).serialize(),
+                             content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return resp.get_json()
+
     def test_index(self):
         """ Home Page """
         resp = self.app.get("/")
@@ -195,6 +232,38 @@ class TestOrderService(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def _delete_after(self, change, order_id):
+        """ Deletes an Order through the API while change() runs between its read and its DELETE """
+        find = Order.find
+
+        def find_then_change(*args, **kwargs):
+            order = find(*args, **kwargs)
+            change()
+            return order
+
+        with patch.object(Order, "find", side_effect=find_then_change), self._in_production():
+            return self.app.delete("/orders/{}".format(order_id))
+
+    def test_delete_order_changed_meanwhile(self):
+        """ Deleting an Order changed by another request after it was read is a conflict """
+        order = self._create_order_with_items(1)
+        resp = self._delete_after(
+            lambda: db.engine.execute('UPDATE "order" SET version = version + 1'), order["id"])
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.app.get("/orders/{}".format(order["id"])).status_code,
+                         status.HTTP_200_OK)
+
+    def test_delete_order_deleted_meanwhile(self):
+        """ Deleting an Order another request deleted after it was read succeeds """
+        order = self._create_order_with_items(1)
+
+        def delete():
+            db.engine.execute("DELETE FROM order_item")
+            db.engine.execute('DELETE FROM "order"')
+
+        resp = self._delete_after(delete, order["id"])
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
     def test_get_order_list_empty_list(self):
         """ Get a list of Orders when no orders present in database """
         resp = self.app.get("/orders")
@@ -240,6 +309,798 @@ class TestOrderService(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 0)
 
+    def test_get_order_list_paginated(self):
+        """ Page through the list of Orders with a cursor """
+        orders = self._create_orders(5)
+        resp = self.app.get("/orders", query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([order["id"] for order in data], [orders[0].id, orders[1].id])
+        cursor = resp.headers["X-Next-Cursor"]
+        self.assertIn('rel="next"', resp.headers["Link"])
+        self.assertIn("after={}".format(cursor), resp.headers["Link"])
+
+        seen = [order["id"] for order in data]
+        while "X-Next-Cursor" in resp.headers:
+            resp = self.app.get("/orders", query_string={"limit": 2,
+                                                         "after": resp.headers["X-Next-Cursor"]})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(order["id"] for order in resp.get_json())
+        self.assertEqual(seen, [order.id for order in orders])
+
+    def test_get_order_list_last_page_has_no_cursor(self):
+        """ The last page of Orders has no next cursor """
+        self._create_orders(2)
+        resp = self.app.get("/orders", query_string="limit=2")
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertNotIn("X-Next-Cursor", resp.headers)
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_order_list_limit_capped(self):
+        """ The page size is capped by the server maximum """
+        self._create_orders(3)
+        page_size_max = app.config["PAGE_SIZE_MAX"]
+        app.config["PAGE_SIZE_MAX"] = 2
+        try:
+            resp = self.app.get("/orders", query_string="limit=100")
+        finally:
+            app.config["PAGE_SIZE_MAX"] = page_size_max
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn("X-Next-Cursor", resp.headers)
+
+    def test_get_order_list_bad_limit(self):
+        """ Get a list of Orders with a limit that is not positive """
+        resp = self.app.get("/orders", query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_list_bad_cursor(self):
+        """ Get a list of Orders with a cursor that was not issued by the service """
+        resp = self.app.get("/orders", query_string="after=not-a-cursor")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_order_list_bad_pagination_in_production(self):
+        """ Answer 400 to a bad limit or cursor when exceptions are not propagated """
+        self._create_orders(2)
+        cursor = self.app.get("/orders", query_string={"limit": 1}).headers["X-Next-Cursor"]
+        with self._in_production():
+            for query in [{"limit": 0}, {"after": "zzz"},
+                          {"sort": "total_amount", "after": cursor}]:
+                resp = self.app.get("/orders", query_string=query)
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+                self.assertEqual(resp.get_json()["error"], "Bad Request")
+
+    def test_query_order_list_by_customer_id_paginated(self):
+        """ Page through the Orders of a Customer """
+        orders = self._create_orders(4)
+        customer_id = orders[0].customer_id
+        resp = self.app.get("/orders", query_string={"customer_id": customer_id, "limit": 1})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertIn("customer_id={}".format(customer_id), resp.headers["Link"])
+
+    def test_get_order_list_query_count(self):
+        """ Listing Orders takes the same number of queries for any number of Orders """
+        self._create_order_with_items(1)
+        with self._count_queries() as statements:
+            resp = self.app.get("/orders")
+        self.assertEqual(len(resp.get_json()), 1)
+        query_count = len(statements)
+
+        for count in range(1, 6):
+            self._create_order_with_items(count)
+        with self._count_queries() as statements:
+            resp = self.app.get("/orders")
+        self.assertEqual(len(resp.get_json()), 6)
+        self.assertEqual(len(statements), query_count)
+
+    def test_query_order_list_by_customer_id_query_count(self):
+        """ Querying Orders by Customer takes the same number of queries for any number of Orders """
+        customer_id = self._create_order_with_items(2)["customer_id"]
+        with self._count_queries() as statements:
+            self.app.get("/orders", query_string={"customer_id": customer_id})
+        query_count = len(statements)
+
+        for _ in range(4):
+            self._create_order_with_items(3)
+        with self._count_queries() as statements:
+            resp = self.app.get("/orders", query_string={"customer_id": customer_id})
+        self.assertEqual(len(resp.get_json()), 5)
+        self.assertEqual(len(statements), query_count)
+
+    def test_get_order_query_count(self):
+        """ Get a single Order with all of its items in one query """
+        order = self._create_order_with_items(5)
+        with self._count_queries() as statements:
+            resp = self.app.get("/orders/{}".format(order["id"]))
+        self.assertEqual(len(resp.get_json()["order_items"]), 5)
+        self.assertEqual(len(statements), 1)
+
+    def test_get_order_list_fields(self):
+        """ List only some fields of the Orders, without querying their items """
+        order = self._create_order_with_items(3)
+        with self._count_queries() as statements:
+            resp = self.app.get("/orders", query_string={"fields": "id, customer_id"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"id": order["id"], "customer_id": order["customer_id"]}])
+        self.assertFalse(any("order_item." in statement for statement in statements))
+
+        resp = self.app.get("/orders", query_string={"include_items": "false"})
+        expected = dict(order)
+        del expected["order_items"]
+        self.assertEqual(resp.get_json(), [expected])
+
+        resp = self.app.get("/orders", query_string={"fields": "id", "include_items": "true"})
+        self.assertEqual(resp.get_json(), [{"id": order["id"], "order_items": order["order_items"]}])
+
+        resp = self.app.get("/orders", query_string={"fields": "id", "stream": "true"})
+        self.assertEqual(resp.get_json(), [{"id": order["id"]}])
+
+    def test_get_order_fields(self):
+        """ Get only some fields of an Order, each projection with its own ETag """
+        order = self._create_order_with_items(3)
+        url = "/orders/{}".format(order["id"])
+        with self._count_queries() as statements:
+            resp = self.app.get(url, query_string={"include_items": "false"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("order_items", resp.get_json())
+        self.assertEqual(resp.get_json()["customer_id"], order["customer_id"])
+        self.assertFalse(any("order_item." in statement for statement in statements))
+
+        resp = self.app.get(url, query_string={"fields": "customer_id"})
+        self.assertEqual(resp.get_json(), {"customer_id": order["customer_id"]})
+        etag = resp.headers["ETag"]
+        self.assertNotEqual(etag, self.app.get(url).headers["ETag"])
+        resp = self.app.get(url, query_string={"fields": "customer_id"},
+                            headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_get_order_bad_fields(self):
+        """ Ask for fields an Order does not have """
+        order = self._create_order_with_items(1)
+        resp = self.app.get("/orders/{}".format(order["id"]), query_string={"fields": "id,price"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/orders", query_string={"fields": "nope"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with self._in_production():
+            resp = self.app.get("/orders", query_string={"fields": "nope"})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.get("/orders/{}".format(order["id"]), query_string={"fields": "nope"})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_order_list_ndjson(self):
+        """ Stream the list of Orders as newline delimited JSON """
+        orders = self._create_orders(3)
+        resp = self.app.get("/orders", headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        data = [json.loads(line) for line in lines]
+        self.assertEqual([order["id"] for order in data], [order.id for order in orders])
+        self.assertEqual(len(data[0]["order_items"]), 1)
+        self.assertIn("created_date", data[0])
+
+    def test_stream_order_list_json_array(self):
+        """ Stream the list of Orders as a chunked JSON array """
+        orders = self._create_orders(3)
+        resp = self.app.get("/orders", query_string="stream=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/json")
+        data = resp.get_json()
+        self.assertEqual([order["id"] for order in data], [order.id for order in orders])
+
+    def test_get_order_list_compressed(self):
+        """ List the Orders gzip compressed for a client that accepts it """
+        self._create_orders(10)
+        headers = {"Accept-Encoding": "gzip"}
+        resp = self.app.get("/orders", headers=headers)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertTrue(resp.headers["ETag"].startswith('W/"'))
+        data = json.loads(gzip.decompress(resp.data))
+        self.assertEqual(data, self.app.get("/orders").get_json())
+        # the weak ETag of the compressed page is still a validator of the page
+        resp = self.app.get("/orders", headers={"Accept-Encoding": "gzip",
+                                                "If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        resp = self.app.get("/orders", query_string="stream=true", headers=headers)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(resp.data)), data)
+
+    def test_get_order_not_compressed(self):
+        """ Send a small Order as it is, even to a client that accepts gzip """
+        order = self._create_order_with_items(1)
+        resp = self.app.get("/orders/{}".format(order["id"]), headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.get_json(), order)
+
+    def test_stream_order_list_in_batches(self):
+        """ Streaming ignores the page size and reads the Orders in batches """
+        orders = self._create_orders(5)
+        batch_size = app.config["STREAM_BATCH_SIZE"]
+        app.config["STREAM_BATCH_SIZE"] = 2
+        try:
+            resp = self.app.get("/orders", query_string={"stream": "true", "limit": 1,
+                                                         "customer_id": orders[0].customer_id})
+            data = resp.get_json()
+        finally:
+            app.config["STREAM_BATCH_SIZE"] = batch_size
+        self.assertEqual(len(data), 5)
+        self.assertTrue(all(len(order["order_items"]) == 1 for order in data))
+
+    def test_stream_order_list_empty(self):
+        """ Stream the list of Orders when there are none """
+        resp = self.app.get("/orders", query_string="stream=true")
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get("/orders", headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.get_data(as_text=True), "")
+
+    def test_list_orders_filtered(self):
+        """ List the Orders matching the filters of the query string """
+        shipped = self._create_order_with_statuses("PLACED", "SHIPPED")
+        placed = self._create_order_with_statuses("PLACED")
+        product_id = placed["order_items"][0]["product_id"]
+        resp = self.app.get("/orders", query_string={"status": "SHIPPED"})
+        self.assertEqual([order["id"] for order in resp.get_json()], [shipped["id"]])
+        resp = self.app.get("/orders", query_string={"status": "PLACED", "limit": 1})
+        self.assertEqual([order["id"] for order in resp.get_json()], [shipped["id"]])
+        self.assertIn("status=PLACED", resp.headers["Link"])
+        resp = self.app.get("/orders", query_string={"product_id": product_id})
+        self.assertIn(placed["id"], [order["id"] for order in resp.get_json()])
+        resp = self.app.get("/orders", query_string={"created_from": "2000-01-01",
+                                                     "created_to": "2000-01-02T00:00:00+00:00"})
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get("/orders", query_string={"total_min": 0, "total_max": 1e12,
+                                                     "stream": "true"})
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_list_orders_sorted(self):
+        """ Page through the Orders sorted by total, largest first """
+        orders = [self._create_order_with_items(count) for count in (1, 3, 2)]
+        totals = sorted(((order["total_amount"], order["id"]) for order in orders), reverse=True)
+        seen = []
+        resp = self.app.get("/orders", query_string={"sort": "-total_amount", "limit": 1})
+        while True:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend((order["total_amount"], order["id"]) for order in resp.get_json())
+            if "X-Next-Cursor" not in resp.headers:
+                break
+            self.assertIn("sort=-total_amount", resp.headers["Link"])
+            resp = self.app.get("/orders", query_string={"sort": "-total_amount", "limit": 1,
+                                                         "after": resp.headers["X-Next-Cursor"]})
+        self.assertEqual(seen, totals)
+        resp = self.app.get("/orders", query_string={"sort": "-created_date", "limit": 1})
+        resp = self.app.get("/orders", query_string={"sort": "-created_date",
+                                                     "after": resp.headers["X-Next-Cursor"]})
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_list_orders_cursor_of_other_sort(self):
+        """ A cursor only pages through the sort it was made for """
+        self._create_orders(2)
+        resp = self.app.get("/orders", query_string={"limit": 1})
+        resp = self.app.get("/orders", query_string={"sort": "total_amount",
+                                                     "after": resp.headers["X-Next-Cursor"]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/orders", query_string={"sort": "price"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_order_json_matches_model(self):
+        """ Orders are encoded exactly as marshalling them with the API model would """
+        order = self._create_order_with_items(2)
+        resp = self.app.get("/orders/{}".format(order["id"]))
+        model = json.loads(json.dumps(marshal(Order.find(order["id"]).serialize(), order_model)))
+        self.assertEqual(resp.get_json(), model)
+        self.assertEqual(list(resp.get_json()), list(model))
+        resp = self.app.get("/orders")
+        self.assertEqual(resp.get_json(), [model])
+
+    def test_list_orders_bad_filters(self):
+        """ List Orders with filters that can't be parsed """
+        for args in [{"status": "LOST"}, {"order_status": "LOST"}, {"created_from": "yesterday"},
+                     {"total_min": "ten"}, {"product_id": "x"}]:
+            resp = self.app.get("/orders", query_string=args)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, args)
+
+    def test_order_stats(self):
+        """ Get the statistics of the Orders with three queries """
+        order = self._create_order_with_statuses("PLACED", "CANCELLED")
+        self._create_order_with_statuses("SHIPPED")
+        with self._count_queries() as statements:
+            resp = self.app.get("/orders/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 3)
+        stats = resp.get_json()
+        self.assertEqual(stats["orders"], 2)
+        self.assertEqual(stats["orders_by_status"], [{"order_status": "PLACED", "orders": 1},
+                                                     {"order_status": "SHIPPED", "orders": 1}])
+        self.assertEqual(stats["items"], 3)
+        self.assertEqual(sorted(row["status"] for row in stats["by_status"]),
+                         ["CANCELLED", "PLACED", "SHIPPED"])
+        self.assertEqual(len(stats["daily"]), 1)
+        resp = self.app.get("/orders/stats", query_string={"customer_id": order["customer_id"],
+                                                           "status": "CANCELLED"})
+        self.assertEqual(resp.get_json()["orders"], 1)
+        resp = self.app.get("/orders/stats", query_string={"created_from": "never"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ship_order_item_query_count(self):
+        """ Ship an order item with an UPDATE of the item and of the Order version """
+        order = self._create_order_with_items(5)
+        item_id = order["order_items"][2]["item_id"]
+        with self._count_queries() as statements:
+            resp = self.app.put("/orders/{}/items/{}/ship".format(order["id"], item_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["order_items"][2]["status"], "SHIPPED")
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(statements[0].startswith("UPDATE order_item"))
+        self.assertTrue(statements[1].startswith('UPDATE "order" SET version'))
+
+    def test_create_orders_bulk(self):
+        """ Create many Orders in one request """
+        orders = [_get_order_factory_with_items(count).serialize() for count in (1, 2, 3)]
+        resp = self.app.post("/orders/bulk", json=orders, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        report = resp.get_json()
+        self.assertEqual(report["created"], 3)
+        self.assertEqual(report["failed"], 0)
+        self.assertEqual([result["index"] for result in report["results"]], [0, 1, 2])
+        for result, count in zip(report["results"], (1, 2, 3)):
+            self.assertEqual(result["status"], status.HTTP_201_CREATED)
+            self.assertNotIn("error", result)
+            resp = self.app.get("/orders/{}".format(result["id"]))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(resp.get_json()["order_items"]), count)
+
+    def test_create_orders_bulk_in_batches(self):
+        """ Create more Orders in bulk than fit in one batch """
+        orders = [_get_order_factory_with_items(2).serialize() for _ in range(5)]
+        batch_size = app.config["BULK_BATCH_SIZE"]
+        app.config["BULK_BATCH_SIZE"] = 2
+        try:
+            resp = self.app.post("/orders/bulk", json=orders, content_type="application/json")
+        finally:
+            app.config["BULK_BATCH_SIZE"] = batch_size
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        ids = [result["id"] for result in resp.get_json()["results"]]
+        self.assertEqual(len(set(ids)), 5)
+        data = self.app.get("/orders").get_json()
+        self.assertEqual([order["id"] for order in data], sorted(ids))
+        self.assertTrue(all(len(order["order_items"]) == 2 for order in data))
+
+    def test_create_orders_bulk_partial_failure(self):
+        """ Create Orders in bulk when some of them are not valid """
+        valid = _get_order_factory_with_items(1).serialize()
+        invalid = _get_order_factory_with_items(0).serialize()
+        resp = self.app.post("/orders/bulk", json=[valid, invalid, valid],
+                             content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        report = resp.get_json()
+        self.assertEqual(report["created"], 2)
+        self.assertEqual(report["failed"], 1)
+        self.assertEqual(report["results"][1]["status"], status.HTTP_400_BAD_REQUEST)
+        self.assertIn("Order Items can't be empty", report["results"][1]["error"])
+        self.assertNotIn("id", report["results"][1])
+        self.assertEqual(len(self.app.get("/orders").get_json()), 2)
+
+    def test_create_orders_bulk_all_invalid(self):
+        """ Create Orders in bulk when none of them are valid """
+        resp = self.app.post("/orders/bulk", json=[{"customer_id": "x"}],
+                             content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["failed"], 1)
+
+    def test_create_orders_bulk_ndjson(self):
+        """ Create Orders in bulk from newline delimited JSON """
+        lines = [json.dumps(_get_order_factory_with_items(1).serialize()),
+                 "not json",
+                 "",
+                 json.dumps(_get_order_factory_with_items(2).serialize())]
+        resp = self.app.post("/orders/bulk", data="\n".join(lines),
+                             content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        report = resp.get_json()
+        self.assertEqual([result["status"] for result in report["results"]],
+                         [status.HTTP_201_CREATED, status.HTTP_400_BAD_REQUEST,
+                          status.HTTP_201_CREATED])
+
+    def test_create_orders_bulk_not_a_list(self):
+        """ Create Orders in bulk with a body that is not a list """
+        resp = self.app.post("/orders/bulk", json=_get_order_factory_with_items(1).serialize(),
+                             content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with self._in_production():
+            resp = self.app.post("/orders/bulk", json=_get_order_factory_with_items(1).serialize(),
+                                 content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_orders_bulk_too_many(self):
+        """ Create more Orders in bulk than allowed in one request """
+        orders = [_get_order_factory_with_items(1).serialize() for _ in range(3)]
+        max_orders = app.config["BULK_MAX_ORDERS"]
+        app.config["BULK_MAX_ORDERS"] = 2
+        try:
+            resp = self.app.post("/orders/bulk", json=orders, content_type="application/json")
+            with self._in_production():
+                production_resp = self.app.post("/orders/bulk", json=orders,
+                                                content_type="application/json")
+        finally:
+            app.config["BULK_MAX_ORDERS"] = max_orders
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(production_resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(self.app.get("/orders").get_json()), 0)
+
+    def test_create_orders_bulk_wrong_content_type(self):
+        """ Create Orders in bulk with the wrong content type """
+        resp = self.app.post("/orders/bulk", data="[]", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def _create_order_with_statuses(self, *statuses):
+        """ Creates an Order with one item in each of the statuses """
+        order_factory = _get_order_factory_with_items(len(statuses))
+        for item, item_status in zip(order_factory.order_items, statuses):
+            item.status = item_status
+        return self._create_new_order(order_factory)
+
+    def test_repeated_transitions_keep_version(self):
+        """ Moving an Order or an item to the status it has keeps its version """
+        order = self._create_order_with_statuses("PLACED", "PLACED")
+        url = "/orders/{}".format(order["id"])
+        item_url = "{}/items/{}".format(url, order["order_items"][0]["item_id"])
+        for path in ("{}/ship".format(url), "{}/ship".format(item_url),
+                     "{}/deliver".format(item_url)):
+            version = self.app.put(path).get_json()["version"]
+            resp = self.app.put(path)
+            self.assertEqual(resp.status_code,
+                             status.HTTP_400_BAD_REQUEST if path.endswith("deliver")
+                             else status.HTTP_200_OK)
+            self.assertEqual(self.app.get(url).get_json()["version"], version)
+
+    def test_ship_orders_bulk(self):
+        """ Ship many Orders in one request """
+        orders = [self._create_order_with_statuses("PLACED", "CANCELLED") for _ in range(3)]
+        resp = self.app.put("/orders/bulk/status", content_type="application/json",
+                            json={"status": "SHIPPED", "order_ids": [order["id"] for order in orders]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        report = resp.get_json()
+        self.assertEqual(report["updated"], 3)
+        self.assertEqual(report["failed"], 0)
+        for order in orders:
+            data = self.app.get("/orders/{}".format(order["id"])).get_json()
+            self.assertEqual([item["status"] for item in data["order_items"]], ["SHIPPED", "CANCELLED"])
+
+    def test_update_orders_bulk_status_partial_failure(self):
+        """ Deliver many Orders when some of them can't be delivered """
+        shipped = self._create_order_with_statuses("SHIPPED", "DELIVERED")
+        placed = self._create_order_with_statuses("SHIPPED", "PLACED")
+        cancelled = self._create_order_with_statuses("CANCELLED")
+        ids = [shipped["id"], placed["id"], cancelled["id"], 0, shipped["id"]]
+        with self._count_queries() as statements:
+            resp = self.app.put("/orders/bulk/status", content_type="application/json",
+                                json={"status": "DELIVERED", "order_ids": ids})
+        # the items are locked and read at once, the id without items is looked up on its own
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()["results"]
+        self.assertEqual([result["id"] for result in results], ids[:4])
+        self.assertEqual([result["status"] for result in results],
+                         [status.HTTP_200_OK, status.HTTP_400_BAD_REQUEST,
+                          status.HTTP_400_BAD_REQUEST, status.HTTP_404_NOT_FOUND])
+        self.assertIn("PLACED", results[1]["error"])
+        self.assertIn("CANCELLED", results[2]["error"])
+        data = self.app.get("/orders/{}".format(placed["id"])).get_json()
+        self.assertEqual([item["status"] for item in data["order_items"]], ["SHIPPED", "PLACED"])
+
+    def test_cancel_items_bulk(self):
+        """ Cancel many items of different Orders in one request """
+        first = self._create_order_with_statuses("PLACED", "SHIPPED")
+        second = self._create_order_with_statuses("PLACED")
+        item_ids = [item["item_id"] for item in first["order_items"] + second["order_items"]]
+        resp = self.app.put("/orders/bulk/status", content_type="application/json",
+                            json={"status": "CANCELLED", "item_ids": item_ids})
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()["results"]
+        self.assertEqual([result["status"] for result in results],
+                         [status.HTTP_200_OK, status.HTTP_400_BAD_REQUEST, status.HTTP_200_OK])
+        self.assertEqual(results[1]["error"], "Item has already been shipped/delivered")
+        data = self.app.get("/orders/{}".format(second["id"])).get_json()
+        self.assertEqual(data["order_items"][0]["status"], "CANCELLED")
+
+    def test_update_orders_bulk_status_none_moved(self):
+        """ Move many Orders when none of them can be moved """
+        resp = self.app.put("/orders/bulk/status", content_type="application/json",
+                            json={"status": "SHIPPED", "order_ids": [0]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["results"][0]["status"], status.HTTP_404_NOT_FOUND)
+
+    def test_update_orders_bulk_status_bad_request(self):
+        """ Move many Orders with a body that is not valid """
+        too_many = list(range(1, app.config["BULK_MAX_ORDERS"] + 2))
+        for body in [[1, 2],
+                     {"status": "PLACED", "order_ids": [1]},
+                     {"status": "LOST", "order_ids": [1]},
+                     {"status": "SHIPPED"},
+                     {"status": "SHIPPED", "order_ids": [1], "item_ids": [1]},
+                     {"status": "SHIPPED", "order_ids": []},
+                     {"status": "SHIPPED", "order_ids": ["1"]},
+                     {"status": "SHIPPED", "item_ids": too_many}]:
+            resp = self.app.put("/orders/bulk/status", json=body, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+            # the same body is refused when exceptions are not propagated
+            with self._in_production():
+                resp = self.app.put("/orders/bulk/status", json=body,
+                                    content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+
+    def test_get_order_cached(self):
+        """ Get a single Order twice, the second time from the cache """
+        order = self._create_order_with_items(2)
+        self.app.get("/orders/{}".format(order["id"]))
+        with self._count_queries() as statements:
+            resp = self.app.get("/orders/{}".format(order["id"]))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), order)
+        # only the version is read, to check the cached Order is current
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("order_item", statements[0])
+        stats = self.app.get("/cache/stats").get_json()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_get_order_changed_by_another_worker(self):
+        """ An Order changed by another worker is not served from the cache """
+        order = self._create_order_with_items(2)
+        url = "/orders/{}".format(order["id"])
+        etag = self.app.get(url).headers["ETag"]
+        # another worker updates the Order, which this worker doesn't hear of
+        cached = Order.cache.get(order["id"])
+        self.app.put(url, json={"customer_id": 5}, content_type="application/json")
+        Order.cache.set(order["id"], cached)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["customer_id"], 5)
+        self.assertEqual(Order.cache.get(order["id"])["customer_id"], 5)
+        # and a deleted Order is not found
+        Order.find(order["id"]).delete()
+        Order.cache.set(order["id"], cached)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIsNone(Order.cache.get(order["id"]))
+
+    def test_metrics(self):
+        """ Export the latency and SQL statements of the requests to Prometheus """
+        order = self._create_order_with_items(2)
+        self.app.get("/orders/{}".format(order["id"]))
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        self.assertIn('http_requests_total{method="POST",route="/orders",status="201"}',
+                      resp.get_data(as_text=True))
+        self.assertIn('http_request_sql_statements_count{method="GET",route="/orders/<int:order_id>"}',
+                      resp.get_data(as_text=True))
+
+    def test_profile_request(self):
+        """ Profile a request through the resources, the model and SQLAlchemy """
+        self._create_order_with_items(2)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with patch.dict(app.config, {"PROFILE_SECRET": "s3cret", "PROFILE_DIR": directory}):
+            resp = self.app.get("/orders", headers={"X-Profile": "s3cret"})
+        self.assertEqual(len(resp.get_json()), 1)
+        stats = pstats.Stats(os.path.join(directory, resp.headers["X-Profile-Dump"]))
+        functions = {(os.path.basename(path), function) for path, _, function in stats.stats}
+        self.assertIn(("service.py", "get"), functions)
+        self.assertIn(("models.py", "serialize"), functions)
+        self.assertIn(("default.py", "do_execute"), functions)
+
+    def test_pool_stats(self):
+        """ Get the stats of the database connection pool """
+        resp = self.app.get("/pool/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("pool", resp.get_json())
+
+    def test_retry_stats(self):
+        """ Get the retries of database work """
+        resp = self.app.get("/retry/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("retries", resp.get_json())
+
+    @contextmanager
+    def _replica_statements(self):
+        """ Routes reads to a replica of the test database and yields the SQL it runs """
+        app.config["DATABASE_REPLICA_URIS"] = DATABASE_URI
+        db.init_replicas(app.config)
+        replica = db.replicas.replicas[0].engine
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(replica, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(replica, "before_cursor_execute", record)
+            app.config["DATABASE_REPLICA_URIS"] = ""
+            db.init_replicas(app.config)
+
+    def test_reads_routed_to_replica(self):
+        """ Reads of GET requests go to a replica, writes to the primary """
+        order = self._create_order_with_items(2)
+        with self._replica_statements() as statements:
+            resp = self.app.get("/orders")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()[0]["id"], order["id"])
+            self.assertTrue(statements)
+            self.assertTrue(all(statement.startswith("SELECT") for statement in statements))
+            del statements[:]
+            resp = self.app.put("/orders/{}/ship".format(order["id"]))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(statements, [])
+            stats = self.app.get("/replicas/stats").get_json()
+            self.assertEqual(len(stats), 1)
+            self.assertTrue(stats[0]["healthy"])
+            self.assertGreaterEqual(stats[0]["reads"], 1)
+
+    def test_cache_filled_from_primary(self):
+        """ A replica that lags behind can't fill the shared cache """
+        order = self._create_order_with_items(1)
+        with patch.object(Order, "cache", SharedCache(FakeRedis())), \
+                self._replica_statements() as statements:
+            resp = self.app.get("/orders/{}".format(order["id"]))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(statements, [])
+            self.assertIsNotNone(Order.cache.get(order["id"]))
+
+    def test_cache_hit_read_from_replica(self):
+        """ A hit of the cache of a worker only reads the version, from a replica """
+        order = self._create_order_with_items(2)
+        url = "/orders/{}".format(order["id"])
+        with self._replica_statements() as replica:
+            self.app.get(url)
+            del replica[:]
+            with self._count_queries() as primary:
+                resp = self.app.get(url)
+        self.assertEqual(resp.get_json(), order)
+        self.assertEqual(primary, [])
+        self.assertEqual(len(replica), 1)
+        self.assertIn("version", replica[0])
+        self.assertNotIn("order_item", replica[0])
+        self.assertEqual(Order.cache.stats()["hits"], 1)
+
+    def test_get_order_cache_invalidated(self):
+        """ Every change to an Order removes it from the cache """
+        order = self._create_order_with_statuses("PLACED", "PLACED", "PLACED")
+        url = "/orders/{}".format(order["id"])
+        item_ids = [item["item_id"] for item in order["order_items"]]
+        changes = [
+            lambda: self.app.put(url, json={"customer_id": 5}, content_type="application/json"),
+            lambda: self.app.put("{}/items/{}/ship".format(url, item_ids[0])),
+            lambda: self.app.put("{}/items/{}/deliver".format(url, item_ids[0])),
+            lambda: self.app.put("/orders/bulk/status", content_type="application/json",
+                                 json={"status": "CANCELLED", "item_ids": item_ids[1:2]}),
+            lambda: self.app.put("{}/cancel".format(url)),
+        ]
+        for change in changes:
+            self.app.get(url)
+            self.assertIsNotNone(Order.cache.get(order["id"]))
+            resp = change()
+            self.assertIn(resp.status_code, (status.HTTP_200_OK, status.HTTP_207_MULTI_STATUS))
+            self.assertIsNone(Order.cache.get(order["id"]))
+
+        self.app.get(url)
+        self.app.delete(url)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_order_not_modified(self):
+        """ Get a single Order that has not changed since the client's copy """
+        order = self._create_order_with_items(2)
+        url = "/orders/{}".format(order["id"])
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith('"'))
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+
+        self.app.put("{}/items/{}/ship".format(url, order["order_items"][0]["item_id"]))
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_get_order_list_not_modified(self):
+        """ Get a page of Orders that has not changed since the client's copy """
+        self._create_orders(3)
+        resp = self.app.get("/orders", query_string="limit=2")
+        etag = resp.headers["ETag"]
+        resp = self.app.get("/orders", query_string="limit=2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        resp = self.app.get("/orders", query_string="limit=3", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_update_order_if_match(self):
+        """ Update an Order only if the client's copy is still current """
+        order = self._create_order_with_items(1)
+        url = "/orders/{}".format(order["id"])
+        etag = self.app.get(url).headers["ETag"]
+        resp = self.app.put(url, json={"customer_id": 7}, content_type="application/json",
+                            headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(self.app.get(url).headers["ETag"], resp.headers["ETag"])
+
+        # the first update changed the Order, so the old ETag no longer matches
+        resp = self.app.put(url, json={"customer_id": 8}, content_type="application/json",
+                            headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get(url).get_json()["customer_id"], 7)
+
+    def test_ship_order_if_match(self):
+        """ Ship an Order only if the client's copy is still current """
+        order = self._create_order_with_items(1)
+        url = "/orders/{}".format(order["id"])
+        resp = self.app.put("{}/ship".format(url), headers={"If-Match": '"stale"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put("{}/ship".format(url), headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put("/orders/0/ship", headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_transition_if_match_changed_meanwhile(self):
+        """ A write landing between the If-Match check and a transition fails the transition """
+        find_version = Order.find_version
+
+        def find_version_then_change(order_id):
+            version = find_version(order_id)
+            db.engine.execute('UPDATE "order" SET version = version + 1')
+            return version
+
+        order = self._create_order_with_items(2)
+        url = "/orders/{}".format(order["id"])
+        item_url = "{}/items/{}".format(url, order["order_items"][0]["item_id"])
+        for path in ("{}/ship".format(url), "{}/ship".format(item_url),
+                     "{}/cancel".format(item_url), "{}/cancel".format(url)):
+            etag = self.app.get(url).headers["ETag"]
+            with patch.object(Order, "find_version", side_effect=find_version_then_change):
+                resp = self.app.put(path, headers={"If-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED, path)
+            data = self.app.get(url).get_json()
+            self.assertEqual([item["status"] for item in data["order_items"]],
+                             [item["status"] for item in order["order_items"]])
+
+    def test_update_order_stale_version(self):
+        """ Update an Order based on a version that is no longer current """
+        order = self._create_order_with_items(1)
+        self.assertEqual(order["version"], 1)
+        url = "/orders/{}".format(order["id"])
+        resp = self.app.put(url, json={"customer_id": 7, "version": 1},
+                            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["version"], 2)
+        self.assertEqual(resp.headers["ETag"], '"{}-2"'.format(order["id"]))
+        resp = self.app.put(url, json={"customer_id": 8, "version": 1},
+                            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.app.get(url).get_json()["customer_id"], 7)
+
+    def test_update_order_stale_version_in_production(self):
+        """ Answer 409 to a stale update when exceptions are not propagated """
+        order = self._create_order_with_items(1)
+        with self._in_production():
+            resp = self.app.put("/orders/{}".format(order["id"]),
+                                json={"customer_id": 5, "version": 7},
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(resp.get_json()["error"], "Conflict")
+
+    def test_update_order_bad_version(self):
+        """ Update an Order with a version that is not an integer """
+        order = self._create_order_with_items(1)
+        resp = self.app.put("/orders/{}".format(order["id"]), json={"customer_id": 7, "version": "1"},
+                            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_wrong_method(self):
         """ Method not allowed """
         resp = self.app.patch("/orders")
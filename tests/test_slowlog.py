@@ -0,0 +1,108 @@
+""" Module for slow request log tests """
+import json
+import unittest
+from unittest.mock import patch
+from flask import Flask
+from sqlalchemy import create_engine
+from service import slowlog
+from service.slowlog import RateLimiter, SlowLog
+from service.statements import StatementTimer
+from .fake_clock import FakeClock
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRateLimiter(unittest.TestCase):
+    """ Test Cases for the rate limit of the slow request log """
+
+    def test_allow(self):
+        """ Allow a burst of events, then one event per period / rate """
+        clock = FakeClock()
+        limiter = RateLimiter(2, period=60, clock=clock)
+        self.assertTrue(limiter.allow())
+        self.assertTrue(limiter.allow())
+        self.assertFalse(limiter.allow())
+        clock.now += 30
+        self.assertTrue(limiter.allow())
+        self.assertFalse(limiter.allow())
+
+
+class TestSlowLog(unittest.TestCase):
+    """ Test Cases for the slow request log """
+
+    def setUp(self):
+        self.clock = FakeClock(step=0.1)
+        self.slow_log = SlowLog(request_threshold=1.0, query_threshold=0.5,
+                                clock=self.clock, sample=lambda: 0.5,
+                                timer=StatementTimer(self.clock))
+        self.engine = create_engine("sqlite://")
+        self.app = Flask(__name__)
+        self.slow_log.init_app(self.app)
+        self.statements = 2
+
+        @self.app.route("/orders/<int:order_id>")
+        def get_order(order_id):  # pylint: disable=unused-variable
+            with self.engine.connect() as conn:
+                for _ in range(self.statements):
+                    conn.execute("SELECT 1")
+            return str(order_id)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def _get(self, *urls):
+        """ Sends GET requests, returning the entries logged """
+        with patch.object(slowlog.logger, "warning") as warning:
+            for url in urls:
+                self.app.test_client().get(url)
+        return [json.loads(call[0][-1]) for call in warning.call_args_list]
+
+    def test_fast_request_not_logged(self):
+        """ Don't log a request and statements under their thresholds """
+        self.assertEqual(self._get("/orders/1"), [])
+
+    def test_slow_request_logged(self):
+        """ Log a slow request with its parameters and statements """
+        self.statements = 5
+        entries = self._get("/orders/1?fields=id&fields=version")
+        self.assertEqual(len(entries), 1)
+        entry = entries[0]
+        self.assertEqual(entry["route"], "/orders/<int:order_id>")
+        self.assertEqual(entry["view_args"], {"order_id": 1})
+        self.assertEqual(entry["args"], {"fields": ["id", "version"]})
+        self.assertEqual(entry["status"], 200)
+        self.assertEqual(len(entry["statements"]), 5)
+        self.assertEqual(entry["statements"][0]["statement"], "SELECT 1")
+        self.assertEqual(entry["statements"][0]["duration_ms"], 100)
+        self.assertIn("rows", entry["statements"][0])
+
+    def test_slow_statement_logged(self):
+        """ Log a fast request when one of its statements was slow """
+        self.slow_log.query_threshold = 0.1
+        entries = self._get("/orders/1")
+        self.assertEqual(len(entries), 1)
+        self.assertLess(entries[0]["duration_ms"], 1000)
+
+    def test_not_sampled(self):
+        """ Don't capture the requests left out of the sample """
+        self.statements = 5
+        self.slow_log.sample_rate = 0.25
+        self.assertEqual(self._get("/orders/1"), [])
+
+    def test_rate_limited(self):
+        """ Write at most max_per_minute entries and count those left out """
+        self.statements = 5
+        self.slow_log.limiter = RateLimiter(1, clock=FakeClock())
+        entries = self._get("/orders/1", "/orders/2", "/orders/3")
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(self.slow_log.stats(), {"logged": 1, "suppressed": 2})
+
+    def test_configure(self):
+        """ Read the thresholds from the app configuration """
+        self.slow_log.configure({"SLOW_REQUEST_MS": 200, "SLOW_QUERY_MS": 50,
+                                 "SLOW_LOG_SAMPLE_RATE": 0.1, "SLOW_LOG_MAX_PER_MINUTE": 3})
+        self.assertEqual(self.slow_log.request_threshold, 0.2)
+        self.assertEqual(self.slow_log.query_threshold, 0.05)
+        self.assertEqual(self.slow_log.sample_rate, 0.1)
+        self.assertEqual(self.slow_log.limiter.rate, 3)
@@ -0,0 +1,41 @@
+""" Module for statement timer tests """
+import unittest
+from flask import Flask
+from sqlalchemy import create_engine
+from service.statements import StatementTimer
+from .fake_clock import FakeClock
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestStatementTimer(unittest.TestCase):
+    """ Test Cases for the statement timer """
+
+    def setUp(self):
+        self.clock = FakeClock(step=1)
+        self.timer = StatementTimer(self.clock)
+        self.engine = create_engine("sqlite://")
+        self.app = Flask(__name__)
+        self.first = []
+        self.second = []
+        self.timer.add_listener(lambda statement, duration, cursor: self.first.append(duration))
+        self.timer.add_listener(lambda statement, duration, cursor: self.second.append(statement))
+
+    def test_times_each_statement_once(self):
+        """ It times a statement once for all of its listeners """
+        with self.app.test_request_context():
+            with self.engine.connect() as conn:
+                conn.execute("SELECT 1")
+                conn.execute("SELECT 2")
+        self.assertEqual(self.first, [1, 1])
+        self.assertEqual(self.second, ["SELECT 1", "SELECT 2"])
+        # one read of the clock before and one after each statement
+        self.assertEqual(self.clock.now, 4)
+
+    def test_ignores_statements_outside_requests(self):
+        """ It ignores the statements sent outside a request """
+        with self.engine.connect() as conn:
+            conn.execute("SELECT 1")
+        self.assertEqual(self.first, [])
+        self.assertEqual(self.second, [])